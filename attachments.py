@@ -0,0 +1,277 @@
+import hashlib
+import json
+import os
+import re
+import socket as locsoc
+import ssl
+import threading
+from dataclasses import dataclass, field
+from typing import BinaryIO, Callable, Dict, List, Optional
+
+CHUNK_SIZE = 64 * 1024
+MAX_HEADER_SIZE = 64 * 1024
+SHA256_RE = re.compile(r'^[0-9a-f]{64}$')
+
+#прочитать строку-заголовок JSON
+def readHeader(rfile: BinaryIO) -> Dict:
+    line = rfile.readline(MAX_HEADER_SIZE)
+    if not line.endswith(b"\n"):
+        raise ValueError("нет заголовка")
+    return json.loads(line)
+
+#отправить строку-заголовок JSON
+def sendHeader(sock: locsoc.socket, header: Dict):
+    sock.sendall(json.dumps(header, ensure_ascii=False).encode('utf-8') + b"\n")
+
+#хеш файла по кускам
+def hashFile(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+#хранилище вложений с адресацией по sha256 (одинаковые файлы хранятся один раз)
+#
+#рядом с файлом <sha256>.chats - чаты, куда он выложен; по ним проверяется доступ
+@dataclass
+class BlobStore:
+    blobDir: str = "attachments"
+    refsLock: threading.Lock = field(default_factory=threading.Lock)
+
+    def blobPath(self, sha256: str) -> str:
+        return os.path.join(self.blobDir, sha256[:2], sha256)
+
+    def exists(self, sha256: str) -> bool:
+        return os.path.exists(self.blobPath(sha256))
+
+    def refsPath(self, sha256: str) -> str:
+        return self.blobPath(sha256) + '.chats'
+
+    #чаты, в которые выложен файл
+    def chatsOf(self, sha256: str) -> List[str]:
+        try:
+            with open(self.refsPath(sha256), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return []
+
+    #отметить, что файл выложен в чат
+    def addRef(self, sha256: str, chatId: str):
+        with self.refsLock:
+            chats = self.chatsOf(sha256)
+            if chatId in chats:
+                return
+            chats.append(chatId)
+            tmpPath = f"{self.refsPath(sha256)}.{threading.get_ident()}.tmp"
+            with open(tmpPath, 'w', encoding='utf-8') as f:
+                json.dump(chats, f, ensure_ascii=False)
+            os.replace(tmpPath, self.refsPath(sha256))
+
+    #принять size байт из потока, проверить хеш и положить в хранилище
+    def receive(self, rfile: BinaryIO, size: int, sha256: str):
+        os.makedirs(os.path.join(self.blobDir, "tmp"), exist_ok=True)
+        tmpPath = os.path.join(self.blobDir, "tmp", f"{sha256}.{threading.get_ident()}")
+        digest = hashlib.sha256()
+        buffer = bytearray(CHUNK_SIZE)
+        view = memoryview(buffer)
+        remaining = size
+        try:
+            with open(tmpPath, 'wb') as f:
+                while remaining:
+                    count = rfile.readinto(view[:min(remaining, CHUNK_SIZE)])
+                    if not count:
+                        raise ConnectionError("передача прервана")
+                    digest.update(view[:count])
+                    f.write(view[:count])
+                    remaining -= count
+            if digest.hexdigest() != sha256:
+                raise ValueError("хеш не совпадает")
+            os.makedirs(os.path.dirname(self.blobPath(sha256)), exist_ok=True)
+            os.replace(tmpPath, self.blobPath(sha256))
+        finally:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+
+#отдельный канал вложений: одна передача на подключение, чат-кадры не блокируются
+#
+#upload:   {"type": "upload", "username", "token", "chatId", "name", "size", "sha256"}\n
+#          <- {"status": "exists"} | {"status": "ready"} -> size байт -> {"status": "success"}
+#          (exists - только если файл уже доступен пользователю через один из его чатов)
+#download: {"type": "download", "username", "token", "sha256"}\n
+#          <- {"status": "success", "size": n}\n + n байт (sendfile), если пользователь в чате с этим файлом
+@dataclass
+class AttachmentServer:
+    store: BlobStore
+    host: str = 'localhost'
+    port: int = 8889
+    maxSize: int = 100 * 1024 * 1024
+    timeout: float = 30.0
+    running: bool = False
+    listenSocket: Optional[locsoc.socket] = None
+    #(username, token) -> bool
+    authenticate: Optional[Callable[[str, str], bool]] = None
+    #(chatId, username, name, size, sha256) -> bool
+    onUploaded: Optional[Callable[[str, str, str, int, str], bool]] = None
+    #участник ли пользователь чата: (chatId, username) -> bool
+    canAccess: Optional[Callable[[str, str], bool]] = None
+    #TLS для канала вложений (токен сессии не должен идти открытым текстом)
+    sslContext: Optional[ssl.SSLContext] = None
+
+    def start(self):
+        self.listenSocket = locsoc.socket(locsoc.AF_INET, locsoc.SOCK_STREAM)
+        self.listenSocket.setsockopt(locsoc.SOL_SOCKET, locsoc.SO_REUSEADDR, 1)
+        self.listenSocket.bind((self.host, self.port))
+        self.listenSocket.listen(16)
+        self.running = True
+        threading.Thread(target=self.acceptTransfers, daemon=True).start()
+        print(f"канал вложений на {self.host}:{self.port}")
+
+    def stop(self):
+        self.running = False
+        if self.listenSocket:
+            self.listenSocket.close()
+
+    def acceptTransfers(self):
+        while self.running:
+            try:
+                sock, address = self.listenSocket.accept()
+            except OSError:
+                break
+            threading.Thread(target=self.handleTransfer, args=(sock, address), daemon=True).start()
+
+    def handleTransfer(self, sock: locsoc.socket, address):
+        try:
+            sock.settimeout(self.timeout)
+            if self.sslContext:
+                sock = self.sslContext.wrap_socket(sock, server_side=True)
+            rfile = sock.makefile('rb')
+            header = readHeader(rfile)
+            username = header.get('username', '')
+            if not self.authenticate or not self.authenticate(username, header.get('token', '')):
+                sendHeader(sock, {"status": "error", "message": "нет доступа"})
+                return
+
+            sha256 = str(header.get('sha256', '')).lower()
+            if not SHA256_RE.match(sha256):
+                sendHeader(sock, {"status": "error", "message": "неверный хеш"})
+                return
+
+            if header.get('type') == 'upload':
+                self.handleUpload(sock, rfile, header, username, sha256)
+            elif header.get('type') == 'download':
+                self.handleDownload(sock, username, sha256)
+            else:
+                sendHeader(sock, {"status": "error", "message": "неизвестный запрос"})
+        except Exception as e:
+            print(f"ошибка передачи {address}: {e}")
+        finally:
+            sock.close()
+
+    def handleUpload(self, sock: locsoc.socket, rfile: BinaryIO, header: Dict, username: str, sha256: str):
+        chatId = header.get('chatId', '')
+        name = os.path.basename(str(header.get('name', sha256)))
+        size = int(header.get('size', -1))
+        if size < 0 or size > self.maxSize:
+            sendHeader(sock, {"status": "error", "message": "недопустимый размер"})
+            return
+        if not self.canAccess or not self.canAccess(chatId, username):
+            sendHeader(sock, {"status": "error", "message": "нет доступа к чату"})
+            return
+
+        if self.store.exists(sha256) and self.canRead(username, sha256):
+            #файл уже есть и пользователю доступен - байты не передаем;
+            #иначе он должен прислать байты, а не только знать хеш
+            sendHeader(sock, {"status": "exists", "sha256": sha256})
+            size = os.path.getsize(self.store.blobPath(sha256))
+        else:
+            sendHeader(sock, {"status": "ready"})
+            self.store.receive(rfile, size, sha256)
+
+        self.store.addRef(sha256, chatId)
+        if self.onUploaded:
+            self.onUploaded(chatId, username, name, size, sha256)
+        sendHeader(sock, {"status": "success", "sha256": sha256})
+
+    #доступно ли вложение пользователю: он в одном из чатов, куда оно выложено
+    def canRead(self, username: str, sha256: str) -> bool:
+        return bool(self.canAccess) and any(self.canAccess(chatId, username) for chatId in self.store.chatsOf(sha256))
+
+    def handleDownload(self, sock: locsoc.socket, username: str, sha256: str):
+        path = self.store.blobPath(sha256)
+        if not self.canRead(username, sha256):
+            #тот же ответ, что и для отсутствующего, чтобы не выдавать наличие файла
+            sendHeader(sock, {"status": "error", "message": "вложение не найдено"})
+            return
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            sendHeader(sock, {"status": "error", "message": "вложение не найдено"})
+            return
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            sendHeader(sock, {"status": "success", "size": size})
+            #байты идут из файла в сокет ядром, без буферов Python
+            #(через TLS sendfile сам переходит на обычный send)
+            sock.sendfile(f)
+
+#открыть канал вложений (с TLS, если передан контекст)
+def openChannel(host: str, port: int, sslContext: Optional[ssl.SSLContext] = None):
+    sock = locsoc.create_connection((host, port))
+    if sslContext:
+        return sslContext.wrap_socket(sock, server_hostname=host)
+    return sock
+
+#загрузить файл на сервер (на стороне клиента)
+def uploadFile(host: str, port: int, username: str, token: str, chatId: str, path: str, sslContext: Optional[ssl.SSLContext] = None) -> Dict:
+    size = os.path.getsize(path)
+    sha256 = hashFile(path)
+    with openChannel(host, port, sslContext) as sock:
+        rfile = sock.makefile('rb')
+        sendHeader(sock, {
+            "type": "upload",
+            "username": username,
+            "token": token,
+            "chatId": chatId,
+            "name": os.path.basename(path),
+            "size": size,
+            "sha256": sha256
+        })
+        reply = readHeader(rfile)
+        if reply.get('status') == 'ready':
+            with open(path, 'rb') as f:
+                sock.sendfile(f)
+            reply = readHeader(rfile)
+        elif reply.get('status') == 'exists':
+            reply = readHeader(rfile)
+        return reply
+
+#скачать вложение в файл (на стороне клиента)
+def downloadFile(host: str, port: int, username: str, token: str, sha256: str, destPath: str, sslContext: Optional[ssl.SSLContext] = None) -> Dict:
+    with openChannel(host, port, sslContext) as sock:
+        rfile = sock.makefile('rb')
+        sendHeader(sock, {
+            "type": "download",
+            "username": username,
+            "token": token,
+            "sha256": sha256
+        })
+        reply = readHeader(rfile)
+        if reply.get('status') != 'success':
+            return reply
+        remaining = reply['size']
+        digest = hashlib.sha256()
+        tmpPath = destPath + '.part'
+        with open(tmpPath, 'wb') as f:
+            while remaining:
+                chunk = rfile.read(min(remaining, CHUNK_SIZE))
+                if not chunk:
+                    raise ConnectionError("передача прервана")
+                digest.update(chunk)
+                f.write(chunk)
+                remaining -= len(chunk)
+        if digest.hexdigest() != sha256:
+            os.remove(tmpPath)
+            return {"status": "error", "message": "хеш не совпадает"}
+        os.replace(tmpPath, destPath)
+        return reply
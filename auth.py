@@ -0,0 +1,108 @@
+import hashlib
+import hmac
+import json
+import os
+import sys
+import time
+from typing import Dict, Optional, Tuple
+
+#параметры scrypt (~16 МБ памяти на проверку)
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_SIZE = 16
+
+#захешировать пароль
+def hashPassword(password: str, salt: Optional[bytes] = None) -> Dict:
+    salt = salt or os.urandom(SALT_SIZE)
+    digest = hashlib.scrypt(password.encode('utf-8'), salt=salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P)
+    return {
+        "algo": "scrypt",
+        "n": SCRYPT_N,
+        "r": SCRYPT_R,
+        "p": SCRYPT_P,
+        "salt": salt.hex(),
+        "hash": digest.hex()
+    }
+
+#проверить пароль по записи из clients.json (поддерживает старый открытый формат)
+def verifyPassword(password: str, record: Dict) -> bool:
+    if record.get('algo') == 'scrypt':
+        digest = hashlib.scrypt(
+            password.encode('utf-8'),
+            salt=bytes.fromhex(record['salt']),
+            n=record['n'],
+            r=record['r'],
+            p=record['p']
+        )
+        return hmac.compare_digest(digest.hex(), record['hash'])
+    if 'password' in record:
+        return hmac.compare_digest(str(record['password']), password)
+    return False
+
+#запись нужно перехешировать (открытый пароль или старые параметры)
+def needsRehash(record: Dict) -> bool:
+    return record.get('algo') != 'scrypt' or (record.get('n'), record.get('r'), record.get('p')) != (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+
+#загрузить или создать секрет для подписи токенов
+def loadSecret(secretPath: str) -> bytes:
+    try:
+        with open(secretPath, 'rb') as f:
+            secret = f.read()
+            if len(secret) >= 32:
+                return secret
+    except FileNotFoundError:
+        pass
+    secret = os.urandom(32)
+    fd = os.open(secretPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(secret)
+    return secret
+
+def _sign(secret: bytes, payload: str) -> str:
+    return hmac.new(secret, payload.encode('utf-8'), hashlib.sha256).hexdigest()
+
+#выдать токен сессии: <username>.<поколение>.<срок>.<подпись>
+#
+#поколение хранится в профиле пользователя; logout увеличивает его и отзывает все выданные токены
+def issueToken(secret: bytes, username: str, ttl: float, generation: int = 0) -> str:
+    payload = f"{username}.{generation}.{int(time.time() + ttl)}"
+    return f"{payload}.{_sign(secret, payload)}"
+
+#проверить подпись и срок токена, вернуть (имя пользователя, поколение) или None
+def verifyToken(secret: bytes, token: str) -> Optional[Tuple[str, int]]:
+    try:
+        username, generation, expires, signature = token.rsplit('.', 3)
+        if not hmac.compare_digest(_sign(secret, f"{username}.{generation}.{expires}"), signature):
+            return None
+        if int(expires) < time.time():
+            return None
+        return username, int(generation)
+    except (ValueError, AttributeError):
+        return None
+
+#перевести clients.json с открытых паролей на хеши
+def migrateClients(clientsPath: str = "clients.json") -> int:
+    with open(clientsPath, 'r', encoding='utf-8') as f:
+        clientsData = json.load(f)
+
+    migrated = 0
+    for username, record in clientsData.get('clients', {}).items():
+        if 'password' in record and record.get('algo') != 'scrypt':
+            clientsData['clients'][username] = hashPassword(str(record['password']))
+            migrated += 1
+
+    if migrated:
+        tmpPath = clientsPath + '.tmp'
+        with open(tmpPath, 'w', encoding='utf-8') as f:
+            json.dump(clientsData, f, ensure_ascii=False, indent=2)
+        os.replace(tmpPath, clientsPath)
+    return migrated
+
+def main():
+    clientsPath = sys.argv[1] if len(sys.argv) > 1 else "clients.json"
+    migrated = migrateClients(clientsPath)
+    print(f"перехешировано паролей: {migrated}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+import os
+import socket as locsoc
+import ssl
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import server
+
+#сравнение стоимости TLS-подключения: полное рукопожатие против возобновления по билету
+#
+#сертификат генерируется локально через openssl, серверная сторона использует
+#тот же контекст и то же рукопожатие, что и Server (createSslContext, wrapClientSocket)
+#
+#использование: python bench_tls.py [число_подключений]
+
+#самоподписанный сертификат для localhost
+def makeCertificate(directory: str):
+    certFile = os.path.join(directory, "cert.pem")
+    keyFile = os.path.join(directory, "key.pem")
+    subprocess.run([
+        "openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+        "-keyout", keyFile, "-out", certFile, "-days", "1",
+        "-subj", "/CN=localhost", "-addext", "subjectAltName=DNS:localhost"
+    ], check=True, capture_output=True)
+    return certFile, keyFile
+
+#эхо-сервер: рукопожатие в потоке подключения, как в Server.handleRequest
+def serve(srv: server.Server, listenSocket: locsoc.socket):
+    def handle(sock):
+        try:
+            tlsSocket = srv.wrapClientSocket(sock)
+            with tlsSocket:
+                data = tlsSocket.recv(64)
+                if data:
+                    tlsSocket.sendall(data)
+        except (OSError, ssl.SSLError):
+            pass
+
+    while True:
+        try:
+            sock, _ = listenSocket.accept()
+        except OSError:
+            break
+        threading.Thread(target=handle, args=(sock,), daemon=True).start()
+
+#одно подключение: время рукопожатия и сессия для следующего раза
+def connectOnce(context: ssl.SSLContext, port: int, session=None):
+    sock = locsoc.create_connection(('localhost', port))
+    started = time.perf_counter()
+    tlsSocket = context.wrap_socket(sock, server_hostname='localhost', session=session)
+    elapsed = time.perf_counter() - started
+    with tlsSocket:
+        #в TLS 1.3 билет приходит после рукопожатия - дочитываем ответ
+        tlsSocket.sendall(b"ping")
+        tlsSocket.recv(64)
+        return elapsed, tlsSocket.session_reused, tlsSocket.session
+
+def report(name: str, times, reused: int):
+    ms = [t * 1000 for t in times]
+    print(f"{name:<14} среднее {statistics.mean(ms):7.3f} мс  медиана {statistics.median(ms):7.3f} мс  возобновлено {reused}/{len(ms)}")
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    with tempfile.TemporaryDirectory() as directory:
+        certFile, keyFile = makeCertificate(directory)
+        srv = server.Server(certFile=certFile, keyFile=keyFile, checkpointer=None)
+        srv.sslContext = srv.createSslContext()
+
+        listenSocket = locsoc.socket(locsoc.AF_INET, locsoc.SOCK_STREAM)
+        listenSocket.bind(('localhost', 0))
+        listenSocket.listen(64)
+        port = listenSocket.getsockname()[1]
+        threading.Thread(target=serve, args=(srv, listenSocket), daemon=True).start()
+
+        context = ssl.create_default_context(cafile=certFile)
+
+        fullTimes = []
+        fullReused = 0
+        for _ in range(count):
+            elapsed, reused, _ = connectOnce(context, port)
+            fullTimes.append(elapsed)
+            fullReused += reused
+
+        _, _, session = connectOnce(context, port)
+        resumedTimes = []
+        resumedReused = 0
+        for _ in range(count):
+            elapsed, reused, session = connectOnce(context, port, session)
+            resumedTimes.append(elapsed)
+            resumedReused += reused
+
+        listenSocket.close()
+        srv.kdfPool.shutdown(wait=False)
+
+    print(f"{ssl.OPENSSL_VERSION}, подключений: {count}")
+    report("полное", fullTimes, fullReused)
+    report("возобновление", resumedTimes, resumedReused)
+    print(f"ускорение: {statistics.mean(fullTimes) / statistics.mean(resumedTimes):.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,57 @@
 import json
 import os
+import threading
+import time
+from collections import OrderedDict
 from dataclasses import dataclass, field
-from typing import List, Optional, Dict
+from typing import Callable, List, Optional, Dict, Tuple
 from datetime import datetime
 
+import filelock
+
 @dataclass
 class Message:
     sender: str
     content: str
     timestamp: str = field(default_factory=lambda: datetime.now().isoformat())
+    position: Optional[int] = None  #номер сообщения в истории чата
+    msgId: Optional[str] = None  #id от клиента для защиты от повторов
+    
+    #в формат файла истории
+    def toDict(self) -> Dict:
+        data = {
+            'sender': self.sender,
+            'content': self.content,
+            'timestamp': self.timestamp
+        }
+        if self.msgId:
+            data['msgId'] = self.msgId
+        return data
+
+#недавние msgId чата: не больше maxSize и не старше ttl секунд
+@dataclass
+class DedupWindow:
+    maxSize: int = 1000
+    ttl: float = 600.0
+    entries: OrderedDict = field(default_factory=OrderedDict)
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    
+    #запомнить принятое сообщение
+    def remember(self, message: Message):
+        now = time.monotonic()
+        self.entries[message.msgId] = (now, message)
+        while self.entries:
+            oldestId, (added, _) = next(iter(self.entries.items()))
+            if len(self.entries) <= self.maxSize and now - added <= self.ttl:
+                break
+            del self.entries[oldestId]
+    
+    #найти сообщение по msgId
+    def get(self, msgId: str) -> Optional[Message]:
+        entry = self.entries.get(msgId)
+        if entry and time.monotonic() - entry[0] <= self.ttl:
+            return entry[1]
+        return None
 
 @dataclass
 class Chat:
@@ -18,9 +61,51 @@ class Chat:
     chatName: Optional[str] = None
     admin: Optional[str] = None
     historyDir: str = "chats_story"
+    #последние сообщения в памяти: (всего сообщений, хвост)
+    tailSize: int = 50
+    tailState: Optional[Tuple[int, List[Message]]] = field(default=None, repr=False, compare=False)
+    dedup: DedupWindow = field(default_factory=DedupWindow, repr=False, compare=False)
+    
+    #запомнить хвост истории в памяти
+    def rememberTail(self, history: List[Message]):
+        self.tailState = (len(history), history[-self.tailSize:])
+    
+    #прочитать историю и запомнить хвост; None - файл не прочитался
+    #(под блокировкой, чтобы не затереть хвост, записанный addMessage)
+    def loadTail(self) -> Optional[List[Message]]:
+        with self.historyLock():
+            history = self.readHistory()
+            if history is not None:
+                self.rememberTail(history)
+        return history
+    
+    #хвост истории из памяти (загрузить, если его еще нет)
+    def recentMessages(self) -> List[Message]:
+        if self.tailState is None and self.loadTail() is None:
+            return []
+        return self.tailState[1]
+    
+    #сообщения начиная с позиции since и общее число (из памяти, если хватает хвоста)
+    def getMessagesSince(self, since: int = 0) -> Tuple[List[Message], int]:
+        since = max(since, 0)
+        state = self.tailState
+        if state is not None:
+            count, tail = state
+            if since >= count - len(tail):
+                return tail[since - (count - len(tail)):], count
+        history = self.loadTail()
+        if history is None:
+            #ошибку чтения не выдавать за пустую историю - у клиента ничего нового
+            return [], since
+        return history[since:], len(history)
     
     #загрузить историю чата
     def loadHistory(self) -> List[Message]:
+        history = self.readHistory()
+        return history if history is not None else []
+    
+    #прочитать файл истории; None - ошибка чтения (в отличие от пустой истории)
+    def readHistory(self) -> Optional[List[Message]]:
         historyPath = os.path.join(self.historyDir, f"{self.chatId}.json")
         if not os.path.exists(historyPath):
             return []
@@ -29,44 +114,73 @@ class Chat:
             with open(historyPath, 'r', encoding='utf-8') as f:
                 data = json.load(f)
                 messages = []
-                for msg in data.get('messages', []):
+                for position, msg in enumerate(data.get('messages', [])):
                     messages.append(Message(
                         sender=msg['sender'],
                         content=msg['content'],
-                        timestamp=msg['timestamp']
+                        timestamp=msg['timestamp'],
+                        position=position,
+                        msgId=msg.get('msgId')
                     ))
                 return messages
         except Exception as e:
             print(f"ошибка загрузки истории {self.chatId}: {e}")
-            return []
+            return None
     
     #сохранить историю чата (сразу после ввода сообщения)
     def saveHistory(self, messages: List[Message]):
         historyPath = os.path.join(self.historyDir, f"{self.chatId}.json")
         try:
             os.makedirs(self.historyDir, exist_ok=True)
-            with open(historyPath, 'w', encoding='utf-8') as f:
+            #через tmp: читатели без блокировки не увидят обрезанный файл
+            tmpPath = f"{historyPath}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmpPath, 'w', encoding='utf-8') as f:
                 json.dump({
-                    'messages': [
-                        {
-                            'sender': msg.sender,
-                            'content': msg.content,
-                            'timestamp': msg.timestamp
-                        }
-                        for msg in messages
-                    ]
+                    'messages': [msg.toDict() for msg in messages]
                 }, f, ensure_ascii=False, indent=2)
+            os.replace(tmpPath, historyPath)
         except Exception as e:
             print(f"ошибка сохранения истории {self.chatId}: {e}")
     
-    #добавить сообщение
-    def addMessage(self, sender: str, content: str) -> Message:
-        message = Message(sender=sender, content=content)
-        history = self.loadHistory()
-        history.append(message)
-        self.saveHistory(history)  #и в JSON
+    #блокировка истории чата: потоки этого процесса и другие процессы кластера
+    def historyLock(self):
+        return filelock.fileLock(os.path.join(self.historyDir, f"{self.chatId}.lock"))
+    
+    #добавить сообщение; onAdded вызывается еще под блокировкой истории,
+    #поэтому видит сообщения в том же порядке, что и файл
+    def addMessage(self, sender: str, content: str, timestamp: Optional[str] = None, msgId: Optional[str] = None,
+                   onAdded: Optional[Callable[[Message], None]] = None) -> Message:
+        message = Message(sender=sender, content=content, msgId=msgId)
+        if timestamp:
+            message.timestamp = timestamp
+        with self.historyLock():
+            history = self.loadHistory()
+            message.position = len(history)
+            history.append(message)
+            self.saveHistory(history)  #и в JSON
+            self.rememberTail(history)
+            if onAdded:
+                onAdded(message)
         return message
     
+    #добавить сообщение, если msgId еще не встречался; (сообщение, новое ли оно)
+    def addMessageOnce(self, sender: str, content: str, msgId: Optional[str] = None,
+                       onAdded: Optional[Callable[[Message], None]] = None) -> Tuple[Message, bool]:
+        if not msgId:
+            return self.addMessage(sender, content, onAdded=onAdded), True
+        
+        with self.dedup.lock:
+            existing = self.dedup.get(msgId)
+            if existing is None:
+                #окно пустое после перезапуска - поискать в хвосте истории
+                existing = next((m for m in self.recentMessages() if m.msgId == msgId), None)
+            if existing is not None:
+                return existing, False
+            
+            message = self.addMessage(sender, content, msgId=msgId, onAdded=onAdded)
+            self.dedup.remember(message)
+            return message, True
+    
     #получить последние сообщения
     def getLastMessages(self, count: int = 10) -> List[Message]:
         history = self.loadHistory()
@@ -111,24 +225,29 @@ class Chat:
             self.admin = kwargs['admin']
 
 #для загрузки всех чатов
-def loadAllChats(chatsPath: str = "chats.json") -> Dict[str, Chat]:
+def loadAllChats(chatsPath: str = "chats.json", historyDir: str = "chats_story") -> Dict[str, Chat]:
     try:
         with open(chatsPath, 'r', encoding='utf-8') as f:
             data = json.load(f)
             chats = {}
             for chatId, info in data.get('chats', {}).items():
-                chats[chatId] = Chat(
-                    chatId=chatId,
-                    chatType=info['type'],
-                    participants=info['participants'],
-                    chatName=info.get('chatName'),
-                    admin=info.get('admin')
-                )
+                chats[chatId] = chatFromInfo(dict(info, chatId=chatId), historyDir)
             return chats
     except Exception as e:
         print(f"ошибка загрузки чатов: {e}")
         return {}
 
+#для восстановления чата из getInfo()
+def chatFromInfo(info: Dict, historyDir: str = "chats_story") -> Chat:
+    return Chat(
+        chatId=info['chatId'],
+        chatType=info['type'],
+        participants=info['participants'],
+        chatName=info.get('chatName'),
+        admin=info.get('admin'),
+        historyDir=historyDir
+    )
+
 #для создания нового чата
 def createChat(chatId: str, chatType: str, participants: List[str], 
                chatName: Optional[str] = None, admin: Optional[str] = None) -> Chat:
@@ -147,8 +266,11 @@ def saveChats(chats: Dict[str, Chat], chatsPath: str = "chats.json"):
         for chatId, chat in chats.items():
             data['chats'][chatId] = chat.getInfo()
         
-        with open(chatsPath, 'w', encoding='utf-8') as f:
+        #через tmp: другие узлы читают chats.json без блокировки
+        tmpPath = f"{chatsPath}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmpPath, 'w', encoding='utf-8') as f:
             json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmpPath, chatsPath)
     except Exception as e:
         print(f"ошибка сохранения чатов: {e}")
 
@@ -0,0 +1,152 @@
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, List, Optional, Tuple
+
+import chat
+
+#двоичный снимок состояния сервера
+#
+#  заголовок  HEADER: magic, версия, время, число чатов, подпись chats.json (размер, mtime_ns)
+#  индекс     INDEX_ENTRY на чат: смещение и длина записи
+#  записи     JSON: {"info": getInfo(), "count": n, "tail": [...], "signature": [size, mtime_ns]}
+#
+#заголовок и индекс фиксированного размера, поэтому файл читается через mmap
+#и каждая запись берется срезом без чтения всего файла в память
+#
+#изменения после снимка находятся по подписям файлов: чаты, чьи истории менялись,
+#дочитываются из своих файлов в фоне уже после старта
+MAGIC = b"LR3CKPT\0"
+VERSION = 1
+HEADER = struct.Struct('<8sHxxdIQq')
+INDEX_ENTRY = struct.Struct('<QI')
+
+#подпись файла для проверки, что он не менялся после снимка
+def fileSignature(path: str) -> Tuple[int, int]:
+    try:
+        st = os.stat(path)
+        return st.st_size, st.st_mtime_ns
+    except OSError:
+        return -1, -1
+
+@dataclass
+class Checkpointer:
+    path: str = "checkpoint.bin"
+    interval: float = 60.0
+    running: bool = False
+
+    #записать снимок состояния сервера
+    def write(self, server: Any):
+        chatsSignature = fileSignature(server.chatsPath)
+        records = []
+        for chatObj in list(server.chats.values()):
+            with chatObj.historyLock():
+                chatObj.recentMessages()
+                if chatObj.tailState is None:
+                    #история не прочиталась - подпись не совпадет, и после старта чат дочитается
+                    count, tail, signature = 0, [], (-1, -1)
+                else:
+                    count, tail = chatObj.tailState
+                    signature = fileSignature(os.path.join(chatObj.historyDir, f"{chatObj.chatId}.json"))
+            records.append(json.dumps({
+                "info": chatObj.getInfo(),
+                "count": count,
+                "tail": [m.toDict() for m in tail],
+                "signature": signature
+            }, ensure_ascii=False).encode('utf-8'))
+
+        offset = HEADER.size + INDEX_ENTRY.size * len(records)
+        index = []
+        for record in records:
+            index.append(INDEX_ENTRY.pack(offset, len(record)))
+            offset += len(record)
+
+        tmpPath = self.path + '.tmp'
+        with open(tmpPath, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, time.time(), len(records), *chatsSignature))
+            f.writelines(index)
+            f.writelines(records)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpPath, self.path)
+
+    #загрузить снимок в сервер; None - снимка нет или он негоден,
+    #иначе список чатов, изменившихся после снимка
+    def restore(self, server: Any) -> Optional[List[str]]:
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return None
+        try:
+            with f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                magic, version, createdAt, chatCount, chatsSize, chatsMtime = HEADER.unpack_from(data, 0)
+                if magic != MAGIC or version != VERSION:
+                    print(f"снимок {self.path} другого формата, пропуск")
+                    return None
+
+                records = []
+                for i in range(chatCount):
+                    offset, length = INDEX_ENTRY.unpack_from(data, HEADER.size + i * INDEX_ENTRY.size)
+                    records.append(json.loads(data[offset:offset + length]))
+        except (OSError, ValueError, struct.error) as e:
+            print(f"ошибка чтения снимка {self.path}: {e}")
+            return None
+
+        #реестр чатов из снимка, если chats.json с тех пор не менялся
+        if fileSignature(server.chatsPath) == (chatsSize, chatsMtime):
+            chats = {}
+            for record in records:
+                chatObj = chat.chatFromInfo(record['info'], server.historyDir)
+                chats[chatObj.chatId] = chatObj
+        else:
+            chats = chat.loadAllChats(server.chatsPath, server.historyDir)
+
+        #хвосты только тех чатов, чьи файлы не менялись
+        warm = set()
+        for record in records:
+            chatObj = chats.get(record['info']['chatId'])
+            if not chatObj:
+                continue
+            historyPath = os.path.join(chatObj.historyDir, f"{chatObj.chatId}.json")
+            if fileSignature(historyPath) == tuple(record['signature']):
+                count = record['count']
+                tail = [chat.Message(**m) for m in record['tail']]
+                #позиции в файл не пишутся - восстановить по числу сообщений
+                for i, message in enumerate(tail):
+                    message.position = count - len(tail) + i
+                chatObj.tailState = (count, tail)
+                warm.add(chatObj.chatId)
+
+        server.chats = chats
+        stale = [chatId for chatId in chats if chatId not in warm]
+        print(f"снимок {self.path}: чатов {len(chats)}, изменились после снимка {len(stale)}")
+        return stale
+
+    #дочитать хвосты чатов, изменившихся после снимка
+    def warmUp(self, server: Any, chatIds: List[str]):
+        for chatId in chatIds:
+            chatObj = server.chats.get(chatId)
+            if chatObj and chatObj.tailState is None:
+                chatObj.getMessagesSince(0)
+
+    #периодически писать снимки
+    def run(self, server: Any):
+        self.running = True
+        while self.running:
+            time.sleep(self.interval)
+            if not self.running:
+                break
+            try:
+                self.write(server)
+            except Exception as e:
+                print(f"ошибка записи снимка: {e}")
+
+    def start(self, server: Any):
+        threading.Thread(target=self.run, args=(server,), daemon=True).start()
+
+    def stop(self):
+        self.running = False
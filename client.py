@@ -1,26 +1,62 @@
 import socket as locsoc
 import json
+import os
+import random
+import ssl
 import threading
+import time
+import uuid
 import sys
+from collections import OrderedDict
 from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Optional, List
+from typing import Optional, List, Dict
+import attachments
+import protocol
 
 @dataclass
 class Client:
     username: str
     host: str = 'localhost'
     port: int = 8888
+    attachmentPort: int = 8889
     socket: Optional[locsoc.socket] = None
     running: bool = False
     currentChat: Optional[str] = None
+    sessionToken: Optional[str] = None
     userChats: List[str] = field(default_factory=list)
+    reader: protocol.FrameReader = field(default_factory=protocol.FrameReader)
+    pendingFrames: List[Dict] = field(default_factory=list)
+    #локальный кэш истории: chatId -> сообщения по порядку позиций
+    cacheDir: str = "client_cache"
+    chatCache: Dict[str, List[Dict]] = field(default_factory=dict)
+    #переподключение: экспоненциальная пауза с полным jitter
+    reconnectBase: float = 0.5
+    reconnectCap: float = 30.0
+    maxReconnectAttempts: int = 10
+    #сервер пингует молчащих клиентов, поэтому долгая тишина - мертвое соединение
+    serverTimeout: float = 60.0
+    #неподтвержденные сообщения: msgId -> запрос
+    outboxSize: int = 100
+    outbox: Dict[str, Dict] = field(default_factory=OrderedDict)
+    #TLS: caFile - сертификат сервера или CA, tlsSession - для возобновления без полного рукопожатия
+    useTls: bool = False
+    caFile: Optional[str] = None
+    sslContext: Optional[ssl.SSLContext] = None
+    tlsSession: Optional[ssl.SSLSession] = None
+    loginRetryAfter: float = 0.0
+    #пишут поток ввода, поток приема (pong, история) и таймеры повторов
+    sendLock: threading.Lock = field(default_factory=threading.Lock)
     
     #подключиться к серверу
     def connect(self):
         try:
+            self.reader = protocol.FrameReader()
+            self.pendingFrames = []
             self.socket = locsoc.socket(locsoc.AF_INET, locsoc.SOCK_STREAM)
             self.socket.connect((self.host, self.port))
+            if self.useTls:
+                self.socket = self.wrapTls(self.socket)
             print(f"[{self.username}] подключен к {self.host}:{self.port}")
             return True
         except ConnectionRefusedError:
@@ -30,28 +66,71 @@ class Client:
             print(f"[{self.username}] ошибка: {e}")
             return False
     
+    #обернуть сокет в TLS, по возможности возобновив прошлую сессию
+    #(если сервер билет уже не примет, будет обычное полное рукопожатие)
+    def wrapTls(self, sock):
+        if self.sslContext is None:
+            self.sslContext = ssl.create_default_context(cafile=self.caFile)
+        return self.sslContext.wrap_socket(sock, server_hostname=self.host, session=self.tlsSession)
+    
+    #запомнить TLS-сессию (в TLS 1.3 билет приходит после рукопожатия, поэтому после входа)
+    def rememberTlsSession(self):
+        if self.useTls and isinstance(self.socket, ssl.SSLSocket) and self.socket.session:
+            self.tlsSession = self.socket.session
+    
     #отправить данные
-    def send(self, data):
+    def send(self, data, quiet=False):
         try:
-            json_data = json.dumps(data, ensure_ascii=False)
-            self.socket.send(json_data.encode('utf-8'))
+            frame = protocol.encodeFrame(data)
+            with self.sendLock:
+                self.socket.sendall(frame)
+            return True
         except Exception as e:
-            print(f"[{self.username}] ошибка отправки: {e}")
+            if not quiet:
+                print(f"[{self.username}] ошибка отправки: {e}")
+            return False
     
     #получить ответ
     def receive(self, timeout=5):
+        if self.pendingFrames:
+            return self.pendingFrames.pop(0)
         try:
             self.socket.settimeout(timeout)
-            data = self.socket.recv(4096)
-            if data:
-                return json.loads(data.decode('utf-8'))
+            while not self.pendingFrames:
+                data = self.socket.recv(4096)
+                if not data:
+                    return None
+                self.pendingFrames.extend(self.reader.feed(data))
+            return self.pendingFrames.pop(0)
         except locsoc.timeout:
             return None
         except Exception as e:
             print(f"[{self.username}] ошибка получения: {e}")
             return None
         finally:
-            self.socket.settimeout(None)
+            try:
+                self.socket.settimeout(None)
+            except OSError:
+                pass
+    
+    #дождаться ответа на запрос; пуши, пришедшие раньше, остаются для listenMessages
+    def receiveReply(self, timeout=5):
+        deadline = time.monotonic() + timeout
+        skipped = []
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                frame = self.receive(remaining)
+                if frame is None:
+                    return None
+                #у пушей есть type (userStatus тоже несет status), у подтверждений - msgId
+                if 'status' in frame and 'type' not in frame and not frame.get('msgId'):
+                    return frame
+                skipped.append(frame)
+        finally:
+            self.pendingFrames[:0] = skipped
     
     #войти в систему
     def login(self, password):
@@ -60,13 +139,33 @@ class Client:
             'username': self.username,
             'password': password
         }
+        return self.authorize(authData)
+    
+    #войти по токену сессии без пароля
+    def resume(self):
+        if not self.sessionToken:
+            return False
+        return self.authorize({
+            'type': 'login',
+            'username': self.username,
+            'token': self.sessionToken
+        })
+    
+    #отправить запрос входа и разобрать ответ
+    def authorize(self, authData):
         self.send(authData)
-        response = self.receive()
+        response = self.receiveReply()
+        #сервер просит подождать - reconnect учтет это перед следующей попыткой
+        self.loginRetryAfter = (response.get('retryAfter') or 0) if response else 0
         if response and response.get('status') == 'success':
             self.userChats = response.get('chats', [])
+            self.sessionToken = response.get('token', self.sessionToken)
+            self.rememberTlsSession()
             print(f"[{self.username}] авторизован")
             return True
         error = response.get('message', 'ошибка') if response else 'нет ответа'
+        if self.loginRetryAfter:
+            error += f", повторите через {self.loginRetryAfter} с"
         print(f"[{self.username}] ошибка: {error}")
         return False
     
@@ -79,7 +178,7 @@ class Client:
             'displayName': displayName or self.username
         }
         self.send(regData)
-        response = self.receive()
+        response = self.receiveReply()
         if response and response.get('status') == 'success':
             print(f"[{self.username}] зарегистрирован")
             return True
@@ -105,16 +204,159 @@ class Client:
             request['chatName'] = chatName
         self.send(request)
     
-    #отправить сообщение
+    #отправить сообщение (хранится в outbox до подтверждения сервера)
     def sendMessage(self, chatId, content):
         message = {
             'type': 'sendMessage',
             'chatId': chatId,
             'sender': self.username,
             'content': content,
-            'timestamp': datetime.now().isoformat()
+            'timestamp': datetime.now().isoformat(),
+            'msgId': uuid.uuid4().hex
         }
-        self.send(message)
+        if len(self.outbox) >= self.outboxSize:
+            _, dropped = self.outbox.popitem(last=False)
+            print(f"[{self.username}] очередь отправки переполнена, потеряно: {dropped['content']}")
+        self.outbox[message['msgId']] = message
+        if not self.send(message, quiet=True):
+            print(f"[{self.username}] нет соединения, сообщение отправится после переподключения")
+    
+    #сервер ответил на sendMessage
+    def handleAck(self, message):
+        msgId = message.get('msgId')
+        request = self.outbox.get(msgId)
+        if request is None:
+            return
+        
+        if message.get('retryAfter') is not None:
+            #попросили подождать - повторить позже, сообщение остается в outbox
+            timer = threading.Timer(message['retryAfter'], self.resend, args=(msgId,))
+            timer.daemon = True
+            timer.start()
+            return
+        
+        del self.outbox[msgId]
+        if message.get('status') != 'success':
+            print(f"\n[ошибка] {message.get('message', 'ошибка отправки')}: {request['content']}")
+            return
+        
+        #свое сообщение в кэш, если оно продолжает его без пропуска
+        cached = self.loadCache(request['chatId'])
+        if message.get('position') == len(cached):
+            cached.append({
+                'sender': self.username,
+                'content': request['content'],
+                'timestamp': message.get('timestamp') or request['timestamp']
+            })
+            self.saveCache(request['chatId'])
+    
+    #повторить неподтвержденное сообщение
+    def resend(self, msgId):
+        request = self.outbox.get(msgId)
+        if request and self.running:
+            self.send(request)
+    
+    #восстановить соединение и сессию после обрыва
+    def reconnect(self):
+        self.loginRetryAfter = 0.0
+        for attempt in range(self.maxReconnectAttempts):
+            if not self.running:
+                return False
+            delay = random.uniform(0, min(self.reconnectCap, self.reconnectBase * 2 ** attempt))
+            #не раньше, чем разрешил лимит сервера
+            delay = max(delay, self.loginRetryAfter)
+            print(f"[{self.username}] переподключение через {delay:.1f} с (попытка {attempt + 1})")
+            time.sleep(delay)
+            
+            if not self.connect():
+                continue
+            if not self.resume():
+                self.socket.close()
+                continue
+            
+            #догнать пропущенное в текущем чате и повторить неподтвержденное
+            if self.currentChat:
+                self.send({'type': 'getChatHistory', 'chatId': self.currentChat, 'since': len(self.loadCache(self.currentChat))})
+            for request in list(self.outbox.values()):
+                self.send(request)
+            return True
+        
+        print(f"[{self.username}] не удалось переподключиться")
+        return False
+    
+    #путь к кэшу чата
+    def cachePath(self, chatId):
+        return os.path.join(self.cacheDir, self.username, f"{chatId}.json")
+    
+    #загрузить кэш чата (с диска один раз, дальше из памяти)
+    def loadCache(self, chatId) -> List[Dict]:
+        if chatId not in self.chatCache:
+            try:
+                with open(self.cachePath(chatId), 'r', encoding='utf-8') as f:
+                    self.chatCache[chatId] = json.load(f).get('messages', [])
+            except (OSError, ValueError):
+                self.chatCache[chatId] = []
+        return self.chatCache[chatId]
+    
+    #сохранить кэш чата
+    def saveCache(self, chatId):
+        path = self.cachePath(chatId)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmpPath = path + '.tmp'
+            with open(tmpPath, 'w', encoding='utf-8') as f:
+                json.dump({'messages': self.chatCache.get(chatId, [])}, f, ensure_ascii=False)
+            os.replace(tmpPath, path)
+        except Exception as e:
+            print(f"[{self.username}] ошибка сохранения кэша {chatId}: {e}")
+    
+    #показать сообщения
+    def printMessages(self, messages):
+        for msg in messages:
+            sender = msg.get('sender', 'неизвестно')
+            content = msg.get('content', '')
+            print(f"{sender}: {content}")
+    
+    #отправить файл в текущий чат по каналу вложений
+    def sendFile(self, path):
+        if not self.currentChat:
+            print("сначала выберите чат: /select <chat_id>")
+            return
+        if not os.path.isfile(path):
+            print(f"[{self.username}] нет файла {path}")
+            return
+        chatId = self.currentChat
+        
+        def transfer():
+            try:
+                reply = attachments.uploadFile(self.host, self.attachmentPort, self.username, self.sessionToken, chatId, path,
+                                               self.sslContext if self.useTls else None)
+                if reply.get('status') == 'success':
+                    print(f"\n[система] файл {os.path.basename(path)} отправлен в {chatId}")
+                else:
+                    print(f"\n[ошибка] {reply.get('message', 'ошибка загрузки')}")
+            except Exception as e:
+                print(f"\n[{self.username}] ошибка загрузки: {e}")
+        
+        #передача идет отдельно и не мешает чату
+        threading.Thread(target=transfer, daemon=True).start()
+    
+    #скачать вложение
+    def downloadFile(self, sha256, destPath=None):
+        destPath = destPath or sha256
+        
+        def transfer():
+            try:
+                reply = attachments.downloadFile(self.host, self.attachmentPort, self.username, self.sessionToken, sha256, destPath,
+                                                 self.sslContext if self.useTls else None)
+                if reply.get('status') == 'success':
+                    print(f"\n[система] сохранено в {destPath}")
+                else:
+                    print(f"\n[ошибка] {reply.get('message', 'ошибка скачивания')}")
+            except Exception as e:
+                print(f"\n[{self.username}] ошибка скачивания: {e}")
+        
+        threading.Thread(target=transfer, daemon=True).start()
     
     #выбрать чат с показом истории
     def selectChat(self, chatId):
@@ -122,7 +364,13 @@ class Client:
             self.currentChat = chatId
             print(f"\n[{self.username}] выбран чат {chatId}")
             
-            request = {'type': 'getChatHistory', 'chatId': chatId}
+            #сразу показать кэш, с сервера взять только новое
+            cached = self.loadCache(chatId)
+            if cached:
+                print(f"\n--- История чата: {chatId} ---")
+                self.printMessages(cached)
+            
+            request = {'type': 'getChatHistory', 'chatId': chatId, 'since': len(cached)}
             self.send(request)
             
         else:
@@ -140,10 +388,34 @@ class Client:
     def handleServerMessage(self, message):
         msgType = message.get('type')
         
-        if msgType == 'message':
+        if message.get('msgId') and 'status' in message:
+            self.handleAck(message)
+        
+        elif message.get('retryAfter') is not None:
+            #сервер просит притормозить
+            print(f"\n[система] {message.get('message', 'сервер занят')}, повторите через {message['retryAfter']} с")
+            if self.running:
+                print(f"{self.username}> ", end='', flush=True)
+        
+        elif msgType == 'ping':
+            #сервер проверяет, живы ли мы
+            self.send({'type': 'pong'})
+        
+        elif msgType == 'message':
             chatId = message.get('chatId')
             sender = message.get('sender')
             content = message.get('content')
+            
+            #положить в кэш, если сообщение продолжает его без пропуска
+            cached = self.loadCache(chatId)
+            if message.get('position') == len(cached):
+                cached.append({
+                    'sender': sender,
+                    'content': content,
+                    'timestamp': message.get('timestamp', '')
+                })
+                self.saveCache(chatId)
+            
             print(f"\n[{chatId}] {sender}: {content}")
             if self.running:
                 print(f"{self.username}> ", end='', flush=True)
@@ -179,16 +451,27 @@ class Client:
             #показать историю при выборе чата
             chatId = message.get('chatId')
             messages = message.get('messages', [])
+            since = message.get('since', 0)
+            total = message.get('total', since + len(messages))
+            cached = self.loadCache(chatId)
             
-            print(f"\n--- История чата: {chatId} ---")
+            if total < len(cached):
+                #история на сервере короче кэша - кэш устарел, загрузить заново
+                self.chatCache[chatId] = []
+                self.saveCache(chatId)
+                self.send({'type': 'getChatHistory', 'chatId': chatId, 'since': 0})
+                return
+            
+            #пока шел ответ, часть сообщений могла прийти push-ем
+            if since <= len(cached) < since + len(messages):
+                cached.extend(messages[len(cached) - since:])
+                self.saveCache(chatId)
+            
+            if since == 0:
+                print(f"\n--- История чата: {chatId} ---")
             if messages:
-                for msg in messages:
-                    sender = msg.get('sender', 'неизвестно')
-                    content = msg.get('content', '')
-                    timestamp = msg.get('timestamp', '')
-                    #time_str = datetime.fromisoformat(timestamp).strftime("%H:%M")
-                    print(f"{sender}: {content}")
-            else:
+                self.printMessages(messages)
+            elif since == 0:
                 print("(нет сообщений)")
             print("---" * 15)
             
@@ -198,22 +481,33 @@ class Client:
     #слушать сообщения от сервера
     def listenMessages(self):
         while self.running:
+            #кадры, пришедшие вместе с ответом на вход
+            while self.pendingFrames:
+                self.handleServerMessage(self.pendingFrames.pop(0))
             try:
+                self.socket.settimeout(self.serverTimeout)
                 data = self.socket.recv(4096)
                 if not data:
                     print(f"[{self.username}] соединение разорвано")
-                    break
-                message = json.loads(data.decode('utf-8'))
-                self.handleServerMessage(message)
-            except ConnectionResetError:
-                print(f"[{self.username}] сервер отключился")
-                break
+                    raise ConnectionError
+                for message in self.reader.feed(data):
+                    self.handleServerMessage(message)
+                continue
             except json.JSONDecodeError:
                 print(f"[{self.username}] ошибка формата")
+                self.reader = protocol.FrameReader()
+                continue
+            except locsoc.timeout:
+                print(f"[{self.username}] сервер не отвечает")
+            except ConnectionResetError:
+                print(f"[{self.username}] сервер отключился")
             except Exception as e:
-                if self.running:
+                if self.running and not isinstance(e, ConnectionError):
                     print(f"[{self.username}] ошибка: {e}")
+            
+            if not self.running or not self.reconnect():
                 break
+        self.running = False
     
     #обрабатывать команды
     def handleCommand(self, cmd):
@@ -253,6 +547,12 @@ class Client:
             else:
                 print("сначала выберите чат: /select <chat_id>")
                 
+        elif cmdType == '/send' and len(parts) > 1:
+            self.sendFile(' '.join(parts[1:]))
+            
+        elif cmdType == '/download' and len(parts) > 1:
+            self.downloadFile(parts[1], ' '.join(parts[2:]) or None)
+            
         elif cmdType == '/help':
             print("команды:")
             print("  /online - кто онлайн")
@@ -261,6 +561,8 @@ class Client:
             print("  /private <user> - создать личный чат")
             print("  /group <user1,user2,...> <name> - создать групповой чат")
             print("  /msg <текст> - отправить сообщение в выбранный чат")
+            print("  /send <путь> - отправить файл в выбранный чат")
+            print("  /download <sha256> [файл] - скачать вложение")
             print("  /exit - выход")
         else:
             print(f"неизвестная команда: {cmdType}")
@@ -323,12 +625,17 @@ class Client:
             self.logout()
 
 def main():
-    if len(sys.argv) != 2:
-        print("использование: python client.py <имя_пользователя>")
+    args = sys.argv[1:]
+    caFile = None
+    if len(args) == 3 and args[1] == '--tls':
+        caFile = args[2]
+        args = args[:1]
+    if len(args) != 1:
+        print("использование: python client.py <имя_пользователя> [--tls <сертификат_сервера.pem>]")
         print("пример: python client.py saccharok")
         return
     
-    client = Client(sys.argv[1])
+    client = Client(args[0], useTls=caFile is not None, caFile=caFile)
     try:
         client.run()
     except KeyboardInterrupt:
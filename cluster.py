@@ -0,0 +1,301 @@
+import hashlib
+import hmac
+import json
+import os
+import queue
+import socket as locsoc
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, List, Optional
+
+import auth
+import protocol
+
+#узел кластера: общая директория присутствия + внутренние TCP-связи между узлами
+#
+#presenceDir/
+#  cluster.key          общий секрет связей
+#  nodes/<nodeId>.json  адрес узла и время последнего heartbeat
+#  users/<user>.json    на каком узле сессия пользователя
+@dataclass
+class ClusterNode:
+    nodeId: str
+    host: str = 'localhost'
+    port: int = 9888
+    presenceDir: str = "cluster"
+    heartbeatInterval: float = 2.0
+    nodeTimeout: float = 6.0
+    running: bool = False
+    secret: bytes = b""
+    listenSocket: Optional[locsoc.socket] = None
+    links: Dict[str, locsoc.socket] = field(default_factory=dict)
+    linksLock: threading.Lock = field(default_factory=threading.Lock)
+    #исходящие очереди по узлам: медленный узел не задерживает остальных и отправителя
+    outboxes: Dict[str, queue.Queue] = field(default_factory=dict)
+    outboxSize: int = 10000
+    onFrame: Optional[Callable[[Dict], None]] = None
+
+    @property
+    def nodesDir(self) -> str:
+        return os.path.join(self.presenceDir, "nodes")
+
+    @property
+    def usersDir(self) -> str:
+        return os.path.join(self.presenceDir, "users")
+
+    def _readJson(self, path: str) -> Optional[Dict]:
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _writeJson(self, path: str, data: Dict):
+        tmpPath = f"{path}.{self.nodeId}.tmp"
+        with open(tmpPath, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmpPath, path)
+
+    def _sign(self, nodeId: str) -> str:
+        return hmac.new(self.secret, nodeId.encode('utf-8'), hashlib.sha256).hexdigest()
+
+    #запустить узел
+    def start(self, onFrame: Callable[[Dict], None]):
+        self.onFrame = onFrame
+        os.makedirs(self.nodesDir, exist_ok=True)
+        os.makedirs(self.usersDir, exist_ok=True)
+        self.secret = auth.loadSecret(os.path.join(self.presenceDir, "cluster.key"))
+
+        #сессии, оставшиеся от прошлого запуска этого узла
+        for username in self.listUsers(self.nodeId):
+            self.releaseUser(username)
+
+        self.listenSocket = locsoc.socket(locsoc.AF_INET, locsoc.SOCK_STREAM)
+        self.listenSocket.setsockopt(locsoc.SOL_SOCKET, locsoc.SO_REUSEADDR, 1)
+        self.listenSocket.bind((self.host, self.port))
+        self.listenSocket.listen(16)
+        self.running = True
+        self.heartbeat()
+
+        threading.Thread(target=self.acceptLinks, daemon=True).start()
+        threading.Thread(target=self.heartbeatLoop, daemon=True).start()
+        print(f"узел кластера {self.nodeId} слушает {self.host}:{self.port}")
+
+    #остановить узел
+    def stop(self):
+        self.running = False
+        for username in self.listUsers(self.nodeId):
+            self.releaseUser(username)
+        try:
+            os.remove(os.path.join(self.nodesDir, f"{self.nodeId}.json"))
+        except OSError:
+            pass
+        with self.linksLock:
+            for outbox in self.outboxes.values():
+                outbox.put(None)
+            self.outboxes.clear()
+        if self.listenSocket:
+            self.listenSocket.close()
+
+    #обновить запись узла
+    def heartbeat(self):
+        self._writeJson(os.path.join(self.nodesDir, f"{self.nodeId}.json"), {
+            "nodeId": self.nodeId,
+            "host": self.host,
+            "port": self.port,
+            "heartbeat": time.time()
+        })
+
+    def heartbeatLoop(self):
+        while self.running:
+            time.sleep(self.heartbeatInterval)
+            try:
+                self.heartbeat()
+            except OSError as e:
+                print(f"ошибка heartbeat узла {self.nodeId}: {e}")
+
+    #живые узлы кластера
+    def liveNodes(self) -> Dict[str, Dict]:
+        nodes = {}
+        now = time.time()
+        try:
+            filenames = os.listdir(self.nodesDir)
+        except OSError:
+            return nodes
+        for filename in filenames:
+            if not filename.endswith('.json'):
+                continue
+            info = self._readJson(os.path.join(self.nodesDir, filename))
+            if info and now - info.get('heartbeat', 0) <= self.nodeTimeout:
+                nodes[info['nodeId']] = info
+        return nodes
+
+    def isNodeAlive(self, nodeId: str) -> bool:
+        if nodeId == self.nodeId:
+            return self.running
+        info = self._readJson(os.path.join(self.nodesDir, f"{nodeId}.json"))
+        return bool(info) and time.time() - info.get('heartbeat', 0) <= self.nodeTimeout
+
+    #занять пользователя за этим узлом; False - он онлайн на другом живом узле
+    def claimUser(self, username: str) -> bool:
+        userPath = os.path.join(self.usersDir, f"{username}.json")
+        try:
+            fd = os.open(userPath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({"nodeId": self.nodeId}, f)
+            return True
+        except FileExistsError:
+            owner = self.locateUser(username)
+            if owner is not None:
+                return False
+            #запись от умершего узла
+            self._writeJson(userPath, {"nodeId": self.nodeId})
+            return True
+
+    #освободить пользователя, если он наш
+    def releaseUser(self, username: str):
+        userPath = os.path.join(self.usersDir, f"{username}.json")
+        info = self._readJson(userPath)
+        if info and info.get('nodeId') == self.nodeId:
+            try:
+                os.remove(userPath)
+            except OSError:
+                pass
+
+    #на каком живом узле пользователь
+    def locateUser(self, username: str) -> Optional[str]:
+        info = self._readJson(os.path.join(self.usersDir, f"{username}.json"))
+        if info and self.isNodeAlive(info.get('nodeId', '')):
+            return info['nodeId']
+        return None
+
+    #пользователи узла (или всех живых узлов)
+    def listUsers(self, nodeId: Optional[str] = None) -> List[str]:
+        users = []
+        liveNodes = self.liveNodes() if nodeId is None else None
+        try:
+            filenames = os.listdir(self.usersDir)
+        except OSError:
+            return users
+        for filename in filenames:
+            if not filename.endswith('.json'):
+                continue
+            info = self._readJson(os.path.join(self.usersDir, filename))
+            if not info:
+                continue
+            if nodeId is not None and info.get('nodeId') == nodeId:
+                users.append(filename[:-5])
+            elif nodeId is None and info.get('nodeId') in liveNodes:
+                users.append(filename[:-5])
+        return users
+
+    #принимать связи от других узлов
+    def acceptLinks(self):
+        while self.running:
+            try:
+                linkSocket, address = self.listenSocket.accept()
+            except OSError:
+                break
+            threading.Thread(target=self.handleLink, args=(linkSocket, address), daemon=True).start()
+
+    #читать кадры с входящей связи
+    def handleLink(self, linkSocket: locsoc.socket, address):
+        reader = protocol.FrameReader()
+        authorized = False
+        try:
+            while self.running:
+                data = linkSocket.recv(65536)
+                if not data:
+                    break
+                for frame in reader.feed(data):
+                    if not authorized:
+                        peer = frame.get('nodeId', '')
+                        if frame.get('type') != 'hello' or not hmac.compare_digest(self._sign(peer), frame.get('auth', '')):
+                            print(f"отклонена связь от {address}")
+                            return
+                        authorized = True
+                        continue
+                    if self.onFrame:
+                        self.onFrame(frame)
+        except Exception as e:
+            print(f"ошибка связи с {address}: {e}")
+        finally:
+            linkSocket.close()
+
+    #исходящая связь к узлу (только из потока отправки этого узла)
+    def _link(self, nodeId: str) -> Optional[locsoc.socket]:
+        link = self.links.get(nodeId)
+        if link:
+            return link
+        info = self._readJson(os.path.join(self.nodesDir, f"{nodeId}.json"))
+        if not info:
+            return None
+        link = locsoc.create_connection((info['host'], info['port']), timeout=self.nodeTimeout)
+        link.setsockopt(locsoc.IPPROTO_TCP, locsoc.TCP_NODELAY, 1)
+        link.sendall(protocol.encodeFrame({
+            "type": "hello",
+            "nodeId": self.nodeId,
+            "auth": self._sign(self.nodeId)
+        }))
+        self.links[nodeId] = link
+        return link
+
+    #поставить кадр в очередь узла; False - очередь переполнена
+    def forward(self, nodeId: str, frame: Dict) -> bool:
+        with self.linksLock:
+            if not self.running:
+                return False
+            outbox = self.outboxes.get(nodeId)
+            if outbox is None:
+                outbox = queue.Queue(self.outboxSize)
+                self.outboxes[nodeId] = outbox
+                threading.Thread(target=self.sendLoop, args=(nodeId, outbox), daemon=True).start()
+        try:
+            outbox.put_nowait(protocol.encodeFrame(frame))
+            return True
+        except queue.Full:
+            print(f"очередь узла {nodeId} переполнена, кадр отброшен")
+            return False
+    
+    #отправлять кадры узлу из его очереди
+    def sendLoop(self, nodeId: str, outbox: queue.Queue):
+        while True:
+            data = outbox.get()
+            if data is None:
+                break
+            #забрать все, что накопилось, одной отправкой
+            chunks = [data]
+            while not outbox.empty():
+                data = outbox.get_nowait()
+                if data is None:
+                    break
+                chunks.append(data)
+            self.sendToNode(nodeId, b"".join(chunks))
+            if data is None:
+                break
+        link = self.links.pop(nodeId, None)
+        if link:
+            link.close()
+    
+    def sendToNode(self, nodeId: str, data: bytes):
+        for attempt in range(2):
+            try:
+                link = self._link(nodeId)
+                if not link:
+                    return
+                link.sendall(data)
+                return
+            except OSError as e:
+                #связь порвалась - переподключиться один раз
+                dropped = self.links.pop(nodeId, None)
+                if dropped:
+                    dropped.close()
+                if attempt:
+                    print(f"ошибка пересылки узлу {nodeId}: {e}")
+
+    #разослать кадр всем живым узлам
+    def broadcast(self, frame: Dict, nodeIds: Optional[Iterable[str]] = None):
+        for nodeId in nodeIds if nodeIds is not None else self.liveNodes():
+            if nodeId != self.nodeId:
+                self.forward(nodeId, frame)
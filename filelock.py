@@ -0,0 +1,36 @@
+import os
+import threading
+from contextlib import contextmanager
+from typing import Dict
+
+try:
+    import fcntl
+except ImportError:  #windows
+    fcntl = None
+
+_registryLock = threading.Lock()
+_locks: Dict[str, threading.RLock] = {}
+_depth: Dict[str, int] = {}
+
+#блокировка по файлу-замку: потоки процесса - через RLock (работает и без fcntl),
+#процессы кластера - через flock поверх него; повторный вход в том же потоке разрешен
+@contextmanager
+def fileLock(lockPath: str):
+    key = os.path.abspath(lockPath)
+    with _registryLock:
+        lock = _locks.setdefault(key, threading.RLock())
+    with lock:
+        _depth[key] = _depth.get(key, 0) + 1
+        try:
+            if _depth[key] > 1 or fcntl is None:
+                yield
+                return
+            os.makedirs(os.path.dirname(key), exist_ok=True)
+            with open(key, 'w') as lockFile:
+                fcntl.flock(lockFile, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lockFile, fcntl.LOCK_UN)
+        finally:
+            _depth[key] -= 1
@@ -0,0 +1,68 @@
+import codecs
+import json
+from dataclasses import dataclass, field
+from typing import Any, Dict, List
+
+MAX_FRAME_SIZE = 1024 * 1024
+
+_decoder = json.JSONDecoder()
+
+#конец объекта, начатого с '{' в позиции pos (индекс после '}'), или None, если он еще не закрыт
+def _objectEnd(text: str, pos: int):
+    depth = 0
+    inString = False
+    escaped = False
+    for i in range(pos, len(text)):
+        ch = text[i]
+        if inString:
+            if escaped:
+                escaped = False
+            elif ch == '\\':
+                escaped = True
+            elif ch == '"':
+                inString = False
+        elif ch == '"':
+            inString = True
+        elif ch in '{[':
+            depth += 1
+        elif ch in '}]':
+            depth -= 1
+            if depth == 0:
+                return i + 1
+    return None
+
+#читатель JSON-кадров: несколько кадров могут прийти одним recv, один кадр - несколькими
+@dataclass
+class FrameReader:
+    buffer: str = ""
+    decoder: Any = field(default_factory=lambda: codecs.getincrementaldecoder('utf-8')())
+
+    #добавить принятые байты и вернуть готовые кадры
+    def feed(self, data: bytes) -> List[Dict]:
+        self.buffer += self.decoder.decode(data)
+        frames = []
+        pos = 0
+        while True:
+            while pos < len(self.buffer) and self.buffer[pos].isspace():
+                pos += 1
+            if pos >= len(self.buffer):
+                self.buffer = ""
+                return frames
+            try:
+                frame, pos = _decoder.raw_decode(self.buffer, pos)
+            except json.JSONDecodeError:
+                #кадр - всегда объект; испорченный кадр - ошибка, а не ожидание данных
+                if self.buffer[pos] != '{' or _objectEnd(self.buffer, pos) is not None:
+                    raise
+                #неполный кадр, дочитаем в следующий раз
+                self.buffer = self.buffer[pos:]
+                if len(self.buffer) > MAX_FRAME_SIZE:
+                    raise
+                return frames
+            if not isinstance(frame, dict):
+                raise json.JSONDecodeError("кадр не объект", self.buffer, pos)
+            frames.append(frame)
+
+#закодировать кадр
+def encodeFrame(message: Dict) -> bytes:
+    return json.dumps(message, ensure_ascii=False).encode('utf-8')
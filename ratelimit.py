@@ -0,0 +1,54 @@
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Tuple
+
+@dataclass
+class TokenBucket:
+    rate: float
+    capacity: float
+    tokens: float = -1.0
+    updated: float = field(default_factory=time.monotonic)
+
+    def __post_init__(self):
+        if self.tokens < 0:
+            self.tokens = self.capacity
+
+    #взять токен, вернуть 0 или сколько секунд ждать
+    def take(self, cost: float = 1.0) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0.0
+        if self.rate <= 0:
+            return float('inf')
+        return (cost - self.tokens) / self.rate
+
+@dataclass
+class RateLimiter:
+    #тип запроса -> (токенов в секунду, размер всплеска)
+    limits: Dict[str, Tuple[float, float]] = field(default_factory=dict)
+    buckets: Dict[Tuple[str, str], TokenBucket] = field(default_factory=dict)
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    #проверить запрос, вернуть 0 или retryAfter в секундах
+    def check(self, key: str, requestType: str) -> float:
+        limit = self.limits.get(requestType)
+        if not limit:
+            return 0.0
+        with self.lock:
+            bucket = self.buckets.get((key, requestType))
+            if bucket is None:
+                bucket = TokenBucket(rate=limit[0], capacity=limit[1])
+                self.buckets[(key, requestType)] = bucket
+            return bucket.take()
+
+    #выбросить полные корзины, чтобы словарь не рос бесконечно
+    def prune(self):
+        now = time.monotonic()
+        with self.lock:
+            for bucketKey, bucket in list(self.buckets.items()):
+                if bucket.tokens + (now - bucket.updated) * bucket.rate >= bucket.capacity:
+                    del self.buckets[bucketKey]
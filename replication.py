@@ -0,0 +1,269 @@
+import hashlib
+import hmac
+import json
+import os
+import queue
+import socket as locsoc
+import threading
+import time
+from array import array
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional
+
+import chat
+
+REPLICATION_TAG = b"replication"
+
+def _subscribeAuth(secret: bytes) -> str:
+    return hmac.new(secret, REPLICATION_TAG, hashlib.sha256).hexdigest()
+
+#упорядоченный журнал изменений основного сервера
+#
+#каждая строка файла - {"seq": n, "op": ..., "data": ...}; запись идет в отдельном
+#потоке, поэтому append только кладет запись в очередь и не тормозит sendToChat
+@dataclass
+class ReplicationLog:
+    logPath: str = "replication.log"
+    host: str = 'localhost'
+    port: int = 7888
+    heartbeatInterval: float = 1.0
+    running: bool = False
+    secret: bytes = b""
+    lastSeq: int = 0
+    size: int = 0
+    #offsets[i] - смещение записи с seq i + 1
+    offsets: array = field(default_factory=lambda: array('Q'))
+    pending: queue.SimpleQueue = field(default_factory=queue.SimpleQueue)
+    written: threading.Condition = field(default_factory=threading.Condition)
+    listenSocket: Optional[locsoc.socket] = None
+
+    #восстановить индекс по существующему журналу
+    def loadIndex(self):
+        self.offsets = array('Q')
+        self.lastSeq = 0
+        self.size = 0
+        if not os.path.exists(self.logPath):
+            return
+        with open(self.logPath, 'rb') as f:
+            offset = 0
+            for line in f:
+                if not line.endswith(b"\n"):
+                    #недописанная запись после падения
+                    break
+                self.offsets.append(offset)
+                offset += len(line)
+            self.size = offset
+        self.lastSeq = len(self.offsets)
+        if self.size != os.path.getsize(self.logPath):
+            with open(self.logPath, 'r+b') as f:
+                f.truncate(self.size)
+
+    #запустить запись журнала и прием подписчиков
+    def start(self, secret: bytes):
+        self.secret = secret
+        self.loadIndex()
+        self.running = True
+        threading.Thread(target=self.writeLoop, daemon=True).start()
+
+        self.listenSocket = locsoc.socket(locsoc.AF_INET, locsoc.SOCK_STREAM)
+        self.listenSocket.setsockopt(locsoc.SOL_SOCKET, locsoc.SO_REUSEADDR, 1)
+        self.listenSocket.bind((self.host, self.port))
+        self.listenSocket.listen(4)
+        threading.Thread(target=self.acceptSubscribers, daemon=True).start()
+        print(f"журнал репликации {self.logPath}: seq {self.lastSeq}, подписчики на {self.host}:{self.port}")
+
+    def stop(self):
+        self.running = False
+        self.pending.put(None)
+        with self.written:
+            self.written.notify_all()
+        if self.listenSocket:
+            self.listenSocket.close()
+
+    #добавить изменение в журнал
+    def append(self, op: str, data: Dict):
+        if self.running:
+            self.pending.put((op, data))
+
+    def writeLoop(self):
+        with open(self.logPath, 'ab') as f:
+            while self.running:
+                item = self.pending.get()
+                batch = []
+                while item is not None:
+                    batch.append(item)
+                    if self.pending.empty():
+                        break
+                    item = self.pending.get()
+
+                offsets = []
+                offset = self.size
+                seq = self.lastSeq
+                for op, data in batch:
+                    seq += 1
+                    line = json.dumps({"seq": seq, "op": op, "data": data}, ensure_ascii=False).encode('utf-8') + b"\n"
+                    f.write(line)
+                    offsets.append(offset)
+                    offset += len(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+                with self.written:
+                    self.offsets.extend(offsets)
+                    self.lastSeq = seq
+                    self.size = offset
+                    self.written.notify_all()
+
+    def acceptSubscribers(self):
+        while self.running:
+            try:
+                subSocket, address = self.listenSocket.accept()
+            except OSError:
+                break
+            threading.Thread(target=self.streamTo, args=(subSocket, address), daemon=True).start()
+
+    #отдать подписчику журнал начиная с его позиции, потом хвост в реальном времени
+    def streamTo(self, subSocket: locsoc.socket, address):
+        try:
+            subSocket.settimeout(10)
+            request = json.loads(subSocket.makefile('rb').readline() or b"{}")
+            if not hmac.compare_digest(str(request.get('auth', '')), _subscribeAuth(self.secret)):
+                print(f"отклонен подписчик {address}")
+                subSocket.sendall(json.dumps({"error": "неверный секрет", "denied": True}).encode('utf-8') + b"\n")
+                return
+            fromSeq = int(request.get('fromSeq', 0))
+            with self.written:
+                if fromSeq > self.lastSeq:
+                    subSocket.sendall(json.dumps({"error": "позиция впереди журнала", "lastSeq": self.lastSeq}).encode('utf-8') + b"\n")
+                    return
+                offset = self.offsets[fromSeq] if fromSeq < self.lastSeq else self.size
+            print(f"подписчик {address} с позиции {fromSeq}")
+
+            subSocket.settimeout(None)
+            with open(self.logPath, 'rb') as f:
+                while self.running:
+                    with self.written:
+                        if self.size <= offset:
+                            self.written.wait(self.heartbeatInterval)
+                        size = self.size
+                    if size > offset:
+                        #байты журнала уходят в сокет без копирования через Python
+                        offset += subSocket.sendfile(f, offset, size - offset)
+                    else:
+                        subSocket.sendall(b"\n")
+        except Exception as e:
+            print(f"подписчик {address} отключен: {e}")
+        finally:
+            subSocket.close()
+
+#теплый резерв: читает журнал основного сервера и применяет к своим файлам
+@dataclass
+class Standby:
+    server: Any
+    primaryHost: str = 'localhost'
+    primaryPort: int = 7888
+    positionPath: str = "replica.pos"
+    retryInterval: float = 1.0
+    readTimeout: float = 5.0
+    appliedSeq: int = 0
+    running: bool = False
+    lastContact: float = field(default_factory=time.monotonic)
+
+    def loadPosition(self):
+        try:
+            with open(self.positionPath, 'r', encoding='utf-8') as f:
+                self.appliedSeq = int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            self.appliedSeq = 0
+
+    def savePosition(self):
+        tmpPath = self.positionPath + '.tmp'
+        with open(tmpPath, 'w', encoding='utf-8') as f:
+            f.write(str(self.appliedSeq))
+        os.replace(tmpPath, self.positionPath)
+
+    #следить за основным; вернуться после promoteAfter секунд без связи (0 - ждать вечно)
+    #
+    #PermissionError (основной отверг секрет) не перехватывается: это не обрыв связи,
+    #и повышение при живом основном дало бы два основных
+    def run(self, secret: bytes, promoteAfter: float = 0):
+        self.loadPosition()
+        self.server.loadChats()
+        self.running = True
+        self.lastContact = time.monotonic()
+        while self.running:
+            try:
+                self.follow(secret)
+            except PermissionError:
+                raise
+            except Exception as e:
+                print(f"резерв: нет связи с основным ({e}), позиция {self.appliedSeq}")
+            if promoteAfter and time.monotonic() - self.lastContact > promoteAfter:
+                print("резерв: основной недоступен, повышение")
+                return
+            time.sleep(self.retryInterval)
+
+    def follow(self, secret: bytes):
+        with locsoc.create_connection((self.primaryHost, self.primaryPort), timeout=self.readTimeout) as sock:
+            sock.sendall(json.dumps({"fromSeq": self.appliedSeq, "auth": _subscribeAuth(secret)}).encode('utf-8') + b"\n")
+            print(f"резерв: подписан на {self.primaryHost}:{self.primaryPort} с позиции {self.appliedSeq}")
+            buffer = b""
+            while self.running:
+                data = sock.recv(65536)
+                if not data:
+                    raise ConnectionError("основной закрыл соединение")
+                self.lastContact = time.monotonic()
+                buffer += data
+                *lines, buffer = buffer.split(b"\n")
+                for line in lines:
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    if 'error' in record:
+                        if record.get('denied'):
+                            raise PermissionError(f"основной отклонил подписку: {record['error']}")
+                        raise ConnectionError(record['error'])
+                    if record['seq'] <= self.appliedSeq:
+                        continue
+                    self.apply(record['op'], record['data'])
+                    self.appliedSeq = record['seq']
+                    self.savePosition()
+
+    #применить запись журнала к данным резерва
+    def apply(self, op: str, data: Dict):
+        server = self.server
+        if op == 'register':
+            with server.clientsLock():
+                clientsData = server.loadClients()
+                clientsData.setdefault('clients', {})[data['username']] = data['record']
+                server.saveClients(clientsData)
+            with server.userLock(data['username']):
+                if not server.loadUser(data['username']):
+                    server.saveUser(data['username'], data['userData'], updateStatus=False)
+
+        elif op == 'chat':
+            chatObj = chat.chatFromInfo(data, server.historyDir)
+            server.chats[chatObj.chatId] = chatObj
+            server.saveChats()
+            for username in chatObj.participants:
+                server.addUserChat(username, chatObj.chatId)
+
+        elif op == 'message':
+            chatObj = server.chats.get(data['chatId'])
+            if not chatObj:
+                print(f"резерв: сообщение в неизвестный чат {data['chatId']}")
+                return
+            position = data.get('position')
+            if position is None:
+                #старая запись без позиции: сравнить с последним сообщением
+                last = chatObj.getLastMessages(1)
+                if last and (last[0].sender, last[0].content, last[0].timestamp) == (data['sender'], data['content'], data['timestamp']):
+                    return
+            else:
+                _, count = chatObj.getMessagesSince(position)
+                if position < count:
+                    #запись применилась перед падением, до сохранения позиции
+                    return
+                if position > count:
+                    print(f"резерв: пропуск в истории {data['chatId']}: ожидалась позиция {count}, пришла {position}")
+            chatObj.addMessage(data['sender'], data['content'], data['timestamp'], data.get('msgId'))
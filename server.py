@@ -1,11 +1,38 @@
 import socket as locsoc
 import json
 import threading
+import time
 import os
+import ssl
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
 from datetime import datetime
 from typing import Dict, List, Optional, Tuple
+import attachments
+import auth
 import chat
+import checkpoint
+import cluster
+import filelock
+import protocol
+import ratelimit
+import replication
+
+#тип запроса -> (запросов в секунду, всплеск)
+DEFAULT_RATE_LIMITS = {
+    'sendMessage': (5.0, 20.0),
+    'createChat': (0.2, 3.0),
+    'getChatHistory': (2.0, 10.0),
+    'getOnline': (1.0, 5.0),
+    'login': (0.5, 5.0),
+    #вход по токену без KDF - своя, более щедрая корзина на пользователя
+    'resume': (2.0, 10.0),
+    'register': (0.1, 2.0),
+}
+
+#запросы, которые не ограничиваются
+UNLIMITED_REQUESTS = ('ping', 'pong', 'logout')
 
 @dataclass
 class ClientSession:
@@ -13,6 +40,16 @@ class ClientSession:
     socket: locsoc.socket
     address: Tuple[str, int]
     status: str = "online"
+    lastSeen: float = field(default_factory=time.monotonic)
+    #в сокет пишут поток подключения и потоки других пользователей; SSLSocket
+    #не допускает одновременных sendall, да и кадры не должны перемешиваться
+    sendLock: threading.Lock = field(default_factory=threading.Lock)
+    
+    #отправить кадр этой сессии
+    def sendFrame(self, message: Dict):
+        data = protocol.encodeFrame(message)
+        with self.sendLock:
+            self.socket.sendall(data)
 
 @dataclass
 class Server:
@@ -22,8 +59,61 @@ class Server:
     running: bool = False
     clientsPath: str = "clients.json"
     usersDir: str = "clients_story"
+    chatsPath: str = "chats.json"
+    historyDir: str = "chats_story"
     chats: Dict[str, chat.Chat] = field(default_factory=dict)
     onlineUsers: Dict[str, ClientSession] = field(default_factory=dict)
+    #keepalive: пинг молчащих клиентов и отключение мертвых сессий
+    pingInterval: float = 15.0
+    idleTimeout: float = 45.0
+    keepAliveIdle: int = 30
+    keepAliveInterval: int = 10
+    keepAliveCount: int = 3
+    #защита от перегрузки
+    rateLimits: Dict[str, Tuple[float, float]] = field(default_factory=lambda: dict(DEFAULT_RATE_LIMITS))
+    maxInFlight: int = 32
+    busyRetryAfter: float = 0.5
+    #хеши паролей и токены сессий
+    secretPath: str = "server_secret.key"
+    tokenTtl: float = 7 * 24 * 3600
+    kdfWorkers: int = 2
+    #режим кластера (None - одиночный сервер)
+    clusterNode: Optional[cluster.ClusterNode] = None
+    #журнал изменений для теплого резерва (None - без репликации)
+    replicationLog: Optional[replication.ReplicationLog] = None
+    #канал вложений (None - без вложений; узлам кластера нужны разные порты)
+    attachmentPort: Optional[int] = None
+    blobDir: str = "attachments"
+    #снимки состояния для быстрого перезапуска (None - без снимков)
+    checkpointer: Optional[checkpoint.Checkpointer] = field(default_factory=checkpoint.Checkpointer)
+    #TLS (без сертификата - открытый TCP)
+    certFile: Optional[str] = None
+    keyFile: Optional[str] = None
+    handshakeTimeout: float = 10.0
+    maxHandshakes: int = 8
+    
+    def __post_init__(self):
+        self.rateLimiter = ratelimit.RateLimiter(limits=self.rateLimits)
+        self.inFlight = threading.BoundedSemaphore(self.maxInFlight)
+        #scrypt выполняется в ограниченном пуле, чтобы шторм входов не съел процессор
+        self.kdfPool = ThreadPoolExecutor(max_workers=self.kdfWorkers, thread_name_prefix="kdf")
+        self.sessionSecret = b""
+        self.attachmentServer = None
+        #чаты загружены - только тогда есть что писать в снимок при остановке
+        self.chatsLoaded = False
+        self.sslContext = None
+        #одновременные рукопожатия ограничены, чтобы шторм переподключений не съел процессор
+        self.handshakeSlots = threading.BoundedSemaphore(self.maxHandshakes)
+    
+    #блокировки чтения-изменения-записи общих файлов (потоки и узлы кластера)
+    def clientsLock(self):
+        return filelock.fileLock(self.clientsPath + '.lock')
+    
+    def chatsLock(self):
+        return filelock.fileLock(self.chatsPath + '.lock')
+    
+    def userLock(self, username: str):
+        return filelock.fileLock(os.path.join(self.usersDir, f"{username}.lock"))
     
     #загрузка клиентов
     def loadClients(self) -> Dict:
@@ -34,11 +124,13 @@ class Server:
             print(f"ошибка загрузки клиентов: {e}")
             return {"clients": {}}
     
-    #сохранить клиентов
+    #сохранить клиентов (вызывать под clientsLock)
     def saveClients(self, clientsData: Dict):
         try:
-            with open(self.clientsPath, 'w', encoding='utf-8') as f:
+            tmpPath = f"{self.clientsPath}.{os.getpid()}.tmp"
+            with open(tmpPath, 'w', encoding='utf-8') as f:
                 json.dump(clientsData, f, ensure_ascii=False, indent=2)
+            os.replace(tmpPath, self.clientsPath)
         except Exception as e:
             print(f"ошибка сохранения клиентов: {e}")
     
@@ -52,7 +144,7 @@ class Server:
             print(f"ошибка загрузки пользователя {username}: {e}")
             return None
     
-    #сохранить пользователя с обновлением статуса
+    #сохранить пользователя с обновлением статуса (чтение-изменение-запись - под userLock)
     def saveUser(self, username: str, userData: Dict, updateStatus: bool = True):
         userPath = os.path.join(self.usersDir, f"{username}.json")
         try:
@@ -63,36 +155,68 @@ class Server:
             elif updateStatus:
                 userData['status'] = 'offline'
             
-            with open(userPath, 'w', encoding='utf-8') as f:
+            tmpPath = f"{userPath}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmpPath, 'w', encoding='utf-8') as f:
                 json.dump(userData, f, ensure_ascii=False, indent=2)
+            os.replace(tmpPath, userPath)
         except Exception as e:
             print(f"ошибка сохранения пользователя {username}: {e}")
     
     #загрузить чаты
     def loadChats(self):
-        self.chats = chat.loadAllChats()
+        self.chats = chat.loadAllChats(self.chatsPath, self.historyDir)
     
     #сохранить чаты
     def saveChats(self):
-        chat.saveChats(self.chats)
+        with self.chatsLock():
+            if self.clusterNode:
+                #не затереть чаты, созданные на других узлах
+                for chatId, chatObj in chat.loadAllChats(self.chatsPath, self.historyDir).items():
+                    self.chats.setdefault(chatId, chatObj)
+            chat.saveChats(self.chats, self.chatsPath)
     
     #аутентификация
     def authenticate(self, username: str, password: str) -> bool:
         clientsData = self.loadClients()
-        if username in clientsData.get('clients', {}):
-            storedPass = clientsData['clients'][username]['password']
-            return storedPass == password
-        return False
+        record = clientsData.get('clients', {}).get(username)
+        if not record:
+            return False
+        
+        if not self.kdfPool.submit(auth.verifyPassword, password, record).result():
+            return False
+        
+        #старая запись с открытым паролем - перехешировать
+        if auth.needsRehash(record):
+            newRecord = self.kdfPool.submit(auth.hashPassword, password).result()
+            with self.clientsLock():
+                clientsData = self.loadClients()
+                #запись могли поменять, пока считался хеш
+                if clientsData.get('clients', {}).get(username) == record:
+                    clientsData['clients'][username] = newRecord
+                    self.saveClients(clientsData)
+        return True
+    
+    #проверить токен сессии (без KDF); токены старого поколения отозваны logout
+    def authenticateToken(self, username: str, token: str) -> bool:
+        verified = auth.verifyToken(self.sessionSecret, token)
+        if not verified or verified[0] != username:
+            return False
+        userData = self.loadUser(username)
+        return bool(userData) and verified[1] == userData.get('tokenGeneration', 0)
     
     #регистрация
     def handleRegister(self, username: str, password: str, displayName: Optional[str]) -> Dict:
-        clientsData = self.loadClients()
-        
-        if username in clientsData.get('clients', {}):
+        if username in self.loadClients().get('clients', {}):
             return {"status": "error", "message": "пользователь уже существует"}
         
-        clientsData['clients'][username] = {"password": password}
-        self.saveClients(clientsData)
+        #scrypt вне блокировки, чтобы регистрации не выстраивались в очередь за ним
+        record = self.kdfPool.submit(auth.hashPassword, password).result()
+        with self.clientsLock():
+            clientsData = self.loadClients()
+            if username in clientsData.get('clients', {}):
+                return {"status": "error", "message": "пользователь уже существует"}
+            clientsData.setdefault('clients', {})[username] = record
+            self.saveClients(clientsData)
         
         userData = {
             "username": username,
@@ -101,26 +225,39 @@ class Server:
             "chats": []
         }
         self.saveUser(username, userData, updateStatus=False)
+        self.replicate('register', {"username": username, "record": record, "userData": userData})
         
         return {"status": "success", "message": "регистрация успешна"}
     
     #вход
-    def handleLogin(self, username: str, password: str, clientSocket: locsoc.socket, address: Tuple[str, int]) -> Dict:
-        if not self.authenticate(username, password):
+    def handleLogin(self, username: str, password: Optional[str], clientSocket: locsoc.socket, address: Tuple[str, int], token: Optional[str] = None) -> Dict:
+        if token:
+            if not self.authenticateToken(username, token):
+                return {"status": "error", "message": "токен недействителен"}
+        elif password is None or not self.authenticate(username, password):
             return {"status": "error", "message": "неверные данные"}
         
-        if username in self.onlineUsers:
-            return {"status": "error", "message": "пользователь уже онлайн"}
+        oldSession = self.onlineUsers.get(username)
+        if oldSession:
+            #возобновление сессии по токену вытесняет старое, возможно уже мертвое, соединение
+            if not token or oldSession.socket is clientSocket:
+                return {"status": "error", "message": "пользователь уже онлайн"}
+            self.reapSession(username, oldSession)
         
         userData = self.loadUser(username)
         if not userData:
             return {"status": "error", "message": "ошибка загрузки профиля"}
         
+        if self.clusterNode and not self.clusterNode.claimUser(username):
+            return {"status": "error", "message": "пользователь уже онлайн"}
+        
         session = ClientSession(username=username, socket=clientSocket, address=address)
         self.onlineUsers[username] = session
         
-        userData['status'] = 'online'
-        self.saveUser(username, userData, updateStatus=True)
+        with self.userLock(username):
+            userData = self.loadUser(username) or userData
+            userData['status'] = 'online'
+            self.saveUser(username, userData, updateStatus=True)
         
         #уведомление
         self.broadcastUserStatus(username, 'online')
@@ -128,30 +265,59 @@ class Server:
         return {
             "status": "success",
             "message": "вход успешен",
-            "chats": userData.get('chats', [])
+            "chats": userData.get('chats', []),
+            "token": auth.issueToken(self.sessionSecret, username, self.tokenTtl, userData.get('tokenGeneration', 0))
         }
     
-    #выход
-    def handleLogout(self, username: str):
-        if username in self.onlineUsers:
-            del self.onlineUsers[username]
-
-            userData = self.loadUser(username)
-            if userData:
-                userData['status'] = 'offline'
-                self.saveUser(username, userData, updateStatus=True)
+    #выход; revokeTokens - явный logout, выданные токены больше не действуют
+    def handleLogout(self, username: str, revokeTokens: bool = False):
+        if self.onlineUsers.pop(username, None):
+            if self.clusterNode:
+                self.clusterNode.releaseUser(username)
+            
+            with self.userLock(username):
+                userData = self.loadUser(username)
+                if userData:
+                    userData['status'] = 'offline'
+                    if revokeTokens:
+                        userData['tokenGeneration'] = userData.get('tokenGeneration', 0) + 1
+                    self.saveUser(username, userData, updateStatus=True)
             
             #уведомление
             self.broadcastUserStatus(username, 'offline')
     
-    #отправить сообщение пользователю
+    #отправить сообщение пользователю (на этом узле или переслать его узлу)
     def sendToUser(self, username: str, message: Dict):
-        if username in self.onlineUsers:
+        self.sendToUsers([username], message)
+    
+    #отправить сообщение нескольким пользователям, по одной пересылке на узел
+    def sendToUsers(self, usernames: List[str], message: Dict):
+        remote: Dict[str, List[str]] = {}
+        for username in usernames:
+            if username in self.onlineUsers:
+                self.sendToLocalUser(username, message)
+            elif self.clusterNode:
+                nodeId = self.clusterNode.locateUser(username)
+                if nodeId and nodeId != self.clusterNode.nodeId:
+                    remote.setdefault(nodeId, []).append(username)
+        
+        for nodeId, nodeUsers in remote.items():
+            self.clusterNode.forward(nodeId, {
+                "type": "deliver",
+                "usernames": nodeUsers,
+                "message": message
+            })
+    
+    #отправить сообщение сессии на этом узле
+    def sendToLocalUser(self, username: str, message: Dict):
+        session = self.onlineUsers.get(username)
+        if session and session.status == 'online':
             try:
-                session = self.onlineUsers[username]
-                session.socket.send(json.dumps(message, ensure_ascii=False).encode('utf-8'))
+                session.sendFrame(message)
             except Exception as e:
                 print(f"ошибка отправки {username}: {e}")
+                #больше не тратим время на эту сессию, ее заберет reaper
+                session.status = 'dead'
     
     #разослать статус пользователя
     def broadcastUserStatus(self, username: str, status: str):
@@ -160,42 +326,77 @@ class Server:
             "username": username,
             "status": status
         }
-        for user in self.onlineUsers:
+        for user in list(self.onlineUsers):
             if user != username:
-                self.sendToUser(user, message)
+                self.sendToLocalUser(user, message)
+        
+        if self.clusterNode:
+            self.clusterNode.broadcast({
+                "type": "broadcast",
+                "exclude": username,
+                "message": message
+            })
+    
+    #кадр от другого узла кластера
+    def handleClusterFrame(self, frame: Dict):
+        frameType = frame.get('type')
+        
+        if frameType == 'deliver':
+            for username in frame.get('usernames', []):
+                self.sendToLocalUser(username, frame['message'])
+        
+        elif frameType == 'broadcast':
+            for user in list(self.onlineUsers):
+                if user != frame.get('exclude'):
+                    self.sendToLocalUser(user, frame['message'])
+        
+        elif frameType == 'chat':
+            info = frame['chat']
+            self.chats.setdefault(info['chatId'], chat.chatFromInfo(info, self.historyDir))
     
     #отправить сообщение в чат
-    def sendToChat(self, chatId: str, messageData: Dict) -> bool:
+    def sendToChat(self, chatId: str, messageData: Dict) -> Optional[chat.Message]:
         if chatId not in self.chats:
-            return False
+            return None
         
         chatObj = self.chats[chatId]
         sender = messageData.get('sender')
         content = messageData.get('content')
         
         if not chatObj.canAccess(sender):
-            return False
+            return None
         
-        chatObj.addMessage(sender, content)
+        #в журнал под блокировкой чата, чтобы порядок в журнале совпадал с историей
+        message, isNew = chatObj.addMessageOnce(sender, content, messageData.get('msgId'),
+                                                onAdded=lambda m: self.replicateMessage(chatId, m))
+        if not isNew:
+            #повтор уже принятого сообщения: подтвердить, но не хранить и не рассылать снова
+            return message
         
-        for participant in chatObj.participants:
-            if participant != sender:
-                self.sendToUser(participant, {
-                    "type": "message",
-                    "chatId": chatId,
-                    "sender": sender,
-                    "content": content,
-                    "timestamp": messageData.get('timestamp', datetime.now().isoformat())
-                })
+        self.sendToUsers([p for p in chatObj.participants if p != sender], {
+            "type": "message",
+            "chatId": chatId,
+            "sender": sender,
+            "content": content,
+            "timestamp": message.timestamp,
+            "position": message.position
+        })
         
-        return True
+        return message
     
-    def getChatHistory(self, chatId: str) -> List[Dict]:
+    #история чата начиная с позиции since и общее число сообщений
+    def getChatHistory(self, chatId: str, since: int = 0) -> Tuple[List[Dict], int]:
         if chatId not in self.chats:
-            return []
+            return [], 0
         
         chatObj = self.chats[chatId]
-        messages = chatObj.loadHistory()
+        if self.clusterNode:
+            #файлы пишут и другие узлы, хвосту в памяти верить нельзя
+            messages = chatObj.loadHistory()
+            total = len(messages)
+            messages = messages[max(since, 0):]
+        else:
+            messages, total = chatObj.getMessagesSince(since)
         
         history = []
         for msg in messages:
@@ -205,7 +406,7 @@ class Server:
                 "timestamp": msg.timestamp
             })
         
-        return history
+        return history, total
     
     #создать новый чат
     def createChat(self, chatType: str, participants: List[str], creator: str, chatName: Optional[str]) -> str:
@@ -219,110 +420,323 @@ class Server:
             chatType=chatType,
             participants=participants,
             chatName=chatName,
-            admin=creator
+            admin=creator,
+            historyDir=self.historyDir
         )
         
         self.chats[chatId] = chatObj
         self.saveChats()
+        self.replicate('chat', chatObj.getInfo())
+        
+        if self.clusterNode:
+            self.clusterNode.broadcast({"type": "chat", "chat": chatObj.getInfo()})
         
         for username in participants:
+            self.addUserChat(username, chatId)
+        
+        self.sendToUsers(participants, {
+            "type": "chatCreated",
+            "chatId": chatId,
+            "chatName": chatName
+        })
+        
+        return chatId
+    
+    #добавить чат в профиль пользователя
+    def addUserChat(self, username: str, chatId: str):
+        with self.userLock(username):
             userData = self.loadUser(username)
             if userData and chatId not in userData.get('chats', []):
                 userData['chats'].append(chatId)
                 self.saveUser(username, userData, updateStatus=False)
-                
-            if username in self.onlineUsers:
-                self.sendToUser(username, {
-                    "type": "chatCreated",
-                    "chatId": chatId,
-                    "chatName": chatName
-                })
-        
-        return chatId
+    
+    #записать изменение в журнал репликации
+    def replicate(self, op: str, data: Dict):
+        if self.replicationLog:
+            self.replicationLog.append(op, data)
+    
+    #записать сообщение чата в журнал репликации
+    def replicateMessage(self, chatId: str, message: chat.Message):
+        self.replicate('message', {
+            "chatId": chatId,
+            "sender": message.sender,
+            "content": message.content,
+            "timestamp": message.timestamp,
+            "msgId": message.msgId,
+            "position": message.position
+        })
+    
+    #вложение загружено - сообщить о нем в чат
+    def postAttachment(self, chatId: str, username: str, name: str, size: int, sha256: str) -> bool:
+        return bool(self.sendToChat(chatId, {
+            "sender": username,
+            "content": f"[вложение] {name}, {size} байт: /download {sha256} {name}"
+        }))
+    
+    #можно ли пользователю загрузить вложение в чат
+    def canPostTo(self, chatId: str, username: str) -> bool:
+        return chatId in self.chats and self.chats[chatId].canAccess(username)
+    
+    #записать в пустой журнал уже существующие данные, чтобы резерв мог начать с нуля
+    def replicateBaseline(self):
+        for username, record in self.loadClients().get('clients', {}).items():
+            userData = self.loadUser(username)
+            if userData:
+                self.replicate('register', {"username": username, "record": record, "userData": userData})
+        for chatObj in list(self.chats.values()):
+            self.replicate('chat', chatObj.getInfo())
+            for message in chatObj.loadHistory():
+                self.replicateMessage(chatObj.chatId, message)
     
     #получить список онлайн
     def getOnlineList(self) -> List[str]:
+        if self.clusterNode:
+            return sorted(set(self.onlineUsers) | set(self.clusterNode.listUsers()))
         return list(self.onlineUsers.keys())
     
-    #обработать запрос
+    #обработать один запрос, None - ответ не нужен
+    def dispatchRequest(self, request: Dict, clientSocket: locsoc.socket, address: Tuple[str, int]) -> Optional[Dict]:
+        requestType = request.get('type')
+        response = {"status": "error", "message": "неизвестный запрос"}
+        
+        if requestType == 'ping':
+            return {"type": "pong"}
+        
+        if requestType == 'pong':
+            return None
+        
+        if requestType == 'login':
+            response = self.handleLogin(
+                request['username'],
+                request.get('password'),
+                clientSocket,
+                address,
+                request.get('token')
+            )
+        
+        elif requestType == 'register':
+            response = self.handleRegister(
+                request['username'],
+                request['password'],
+                request.get('displayName')
+            )
+        
+        elif requestType == 'logout':
+            session = self.onlineUsers.get(request['username'])
+            #отзывать токены может только сама сессия, а не любой, кто знает имя
+            self.handleLogout(request['username'], revokeTokens=bool(session) and session.socket is clientSocket)
+            response = {"status": "success"}
+        
+        elif requestType == 'getOnline':
+            response = {
+                "type": "onlineList",
+                "users": self.getOnlineList()
+            }
+        
+        elif requestType == 'sendMessage':
+            message = self.sendToChat(
+                request['chatId'],
+                request
+            )
+            response = {
+                "status": "success" if message else "error",
+                "message": "отправлено" if message else "ошибка отправки",
+                "chatId": request['chatId'],
+                "msgId": request.get('msgId'),
+                "position": message.position if message else None,
+                #время сервера, как в истории - клиент кладет его в кэш
+                "timestamp": message.timestamp if message else None
+            }
+        
+        elif requestType == 'createChat':
+            chatId = self.createChat(
+                request['chatType'],
+                request['participants'],
+                request['creator'],
+                request.get('chatName')
+            )
+            response = {
+                "status": "success",
+                "chatId": chatId,
+                "message": "чат создан"
+            }
+        
+        elif requestType == 'getChatHistory':
+            chatId = request.get('chatId')
+            since = int(request.get('since', 0))
+            history, total = self.getChatHistory(chatId, since)
+            response = {
+                "type": "chatHistory",
+                "chatId": chatId,
+                "messages": history,
+                "since": since,
+                "total": total
+            }
+        
+        return response
+    
+    #корзина лимита для запроса: (ключ, тип)
+    def rateLimitKey(self, request: Dict, username: Optional[str], address: Tuple[str, int]) -> Tuple[str, str]:
+        requestType = request.get('type')
+        if username:
+            return username, requestType
+        if requestType == 'login' and request.get('token'):
+            #клиенты за одним NAT не делят корзину при возобновлении
+            verified = auth.verifyToken(self.sessionSecret, request['token'])
+            if verified:
+                return verified[0], 'resume'
+        return address[0], requestType
+    
+    #ответ "повторите позже"; msgId только у запросов, где он был (иначе это не подтверждение)
+    def retryReply(self, request: Dict, message: str, retryAfter: float) -> Dict:
+        reply = {
+            "status": "error",
+            "message": message,
+            "requestType": request.get('type'),
+            "retryAfter": retryAfter
+        }
+        if request.get('msgId'):
+            reply["msgId"] = request['msgId']
+        return reply
+    
+    #пропустить запрос через лимиты или ответить retryAfter
+    def admitRequest(self, request: Dict, username: Optional[str], clientSocket: locsoc.socket, address: Tuple[str, int]) -> Optional[Dict]:
+        requestType = request.get('type')
+        if requestType in UNLIMITED_REQUESTS:
+            return self.dispatchRequest(request, clientSocket, address)
+        
+        key, limitType = self.rateLimitKey(request, username, address)
+        retryAfter = self.rateLimiter.check(key, limitType)
+        if retryAfter > 0:
+            return self.retryReply(request, "слишком много запросов", round(retryAfter, 3))
+        
+        if not self.inFlight.acquire(blocking=False):
+            return self.retryReply(request, "сервер перегружен", self.busyRetryAfter)
+        try:
+            return self.dispatchRequest(request, clientSocket, address)
+        finally:
+            self.inFlight.release()
+    
+    #создать TLS-контекст сервера
+    def createSslContext(self) -> ssl.SSLContext:
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(self.certFile, self.keyFile)
+        #билеты сессий: вернувшийся клиент пропускает полное рукопожатие
+        context.options &= ~ssl.OP_NO_TICKET
+        context.num_tickets = 2
+        return context
+    
+    #TLS-рукопожатие в потоке подключения, а не в цикле accept
+    def wrapClientSocket(self, clientSocket: locsoc.socket) -> ssl.SSLSocket:
+        clientSocket.settimeout(self.handshakeTimeout)
+        tlsSocket = self.sslContext.wrap_socket(clientSocket, server_side=True, do_handshake_on_connect=False)
+        try:
+            with self.handshakeSlots:
+                tlsSocket.do_handshake()
+        except Exception:
+            tlsSocket.close()
+            raise
+        return tlsSocket
+    
+    #обработать подключение
     def handleRequest(self, clientSocket: locsoc.socket, address: Tuple[str, int]):
+        reader = protocol.FrameReader()
+        username = None
+        session = None
         try:
+            self.configureKeepAlive(clientSocket)
+            if self.sslContext:
+                clientSocket = self.wrapClientSocket(clientSocket)
+            clientSocket.settimeout(self.idleTimeout)
             while True:
-                data = clientSocket.recv(4096)
+                try:
+                    data = clientSocket.recv(4096)
+                except locsoc.timeout:
+                    print(f"таймаут простоя {address}")
+                    break
                 if not data:
                     break
                 
-                request = json.loads(data.decode('utf-8'))
-                requestType = request.get('type')
-                response = {"status": "error", "message": "неизвестный запрос"}
+                if session:
+                    session.lastSeen = time.monotonic()
                 
-                if requestType == 'login':
-                    response = self.handleLogin(
-                        request['username'],
-                        request['password'],
-                        clientSocket,
-                        address
-                    )
-                
-                elif requestType == 'register':
-                    response = self.handleRegister(
-                        request['username'],
-                        request['password'],
-                        request.get('displayName')
-                    )
-                
-                elif requestType == 'logout':
-                    self.handleLogout(request['username'])
-                    response = {"status": "success"}
-                
-                elif requestType == 'getOnline':
-                    response = {
-                        "type": "onlineList",
-                        "users": self.getOnlineList()
-                    }
-                
-                elif requestType == 'sendMessage':
-                    success = self.sendToChat(
-                        request['chatId'],
-                        request
-                    )
-                    response = {
-                        "status": "success" if success else "error",
-                        "message": "отправлено" if success else "ошибка отправки"
-                    }
-                
-                elif requestType == 'createChat':
-                    chatId = self.createChat(
-                        request['chatType'],
-                        request['participants'],
-                        request['creator'],
-                        request.get('chatName')
-                    )
-                    response = {
-                        "status": "success",
-                        "chatId": chatId,
-                        "message": "чат создан"
-                    }
-                
-                elif requestType == 'getChatHistory':
-                    chatId = request.get('chatId')
-                    history = self.getChatHistory(chatId)
-                    response = {
-                        "type": "chatHistory",
-                        "chatId": chatId,
-                        "messages": history
-                    }
-                
-                #отправить ответ
-                clientSocket.send(json.dumps(response, ensure_ascii=False).encode('utf-8'))
+                for request in reader.feed(data):
+                    response = self.admitRequest(request, username, clientSocket, address)
+                    
+                    #запомнить сессию этого подключения
+                    if request.get('type') == 'login' and response and response.get('status') == 'success':
+                        username = request['username']
+                        session = self.onlineUsers.get(username)
+                        if session and session.socket is not clientSocket:
+                            session = None
+                    
+                    #отправить ответ (после входа - под блокировкой сессии, вместе с пушами)
+                    if response is None:
+                        continue
+                    if session:
+                        session.sendFrame(response)
+                    else:
+                        clientSocket.sendall(protocol.encodeFrame(response))
         
         except json.JSONDecodeError:
             print(f"ошибка формата от {address}")
         except Exception as e:
             print(f"ошибка обработки {address}: {e}")
         finally:
+            #клиент пропал без logout
+            if username and session and self.onlineUsers.get(username) is session:
+                self.handleLogout(username)
             clientSocket.close()
     
+    #настроить TCP keepalive, чтобы ядро само замечало мертвых пиров
+    def configureKeepAlive(self, clientSocket: locsoc.socket):
+        try:
+            clientSocket.setsockopt(locsoc.SOL_SOCKET, locsoc.SO_KEEPALIVE, 1)
+            if hasattr(locsoc, 'TCP_KEEPIDLE'):
+                clientSocket.setsockopt(locsoc.IPPROTO_TCP, locsoc.TCP_KEEPIDLE, self.keepAliveIdle)
+            if hasattr(locsoc, 'TCP_KEEPINTVL'):
+                clientSocket.setsockopt(locsoc.IPPROTO_TCP, locsoc.TCP_KEEPINTVL, self.keepAliveInterval)
+            if hasattr(locsoc, 'TCP_KEEPCNT'):
+                clientSocket.setsockopt(locsoc.IPPROTO_TCP, locsoc.TCP_KEEPCNT, self.keepAliveCount)
+        except OSError as e:
+            print(f"ошибка настройки keepalive: {e}")
+    
+    #отключить мертвую сессию
+    def reapSession(self, username: str, session: ClientSession):
+        if self.onlineUsers.get(username) is not session:
+            return
+        print(f"сессия {username} не отвечает, отключение")
+        session.status = 'dead'
+        self.handleLogout(username)
+        try:
+            #разбудить поток, висящий в recv
+            session.socket.shutdown(locsoc.SHUT_RDWR)
+        except OSError:
+            pass
+    
+    #пинговать молчащих и забирать мертвые сессии
+    def reapSessions(self):
+        while self.running:
+            time.sleep(self.pingInterval)
+            now = time.monotonic()
+            self.rateLimiter.prune()
+            for username, session in list(self.onlineUsers.items()):
+                idle = now - session.lastSeen
+                if session.status == 'dead' or idle > self.idleTimeout:
+                    self.reapSession(username, session)
+                elif idle >= self.pingInterval:
+                    self.sendToLocalUser(username, {"type": "ping"})
+    
+    #перевести открытые пароли в хеши
+    def migrateClients(self):
+        try:
+            with self.clientsLock():
+                migrated = auth.migrateClients(self.clientsPath)
+            if migrated:
+                print(f"перехешировано паролей: {migrated}")
+        except Exception as e:
+            print(f"ошибка миграции клиентов: {e}")
+    
     #при запуске сервера установить всех в offline
     def setAllUsersOffline(self):
         print("установка всех пользователей в офлайн...")
@@ -333,36 +747,87 @@ class Server:
                     if filename.endswith('.json'):
                         username = filename[:-5]  # убрать .json
                         userPath = os.path.join(self.usersDir, filename)
-                        try:
-                            with open(userPath, 'r', encoding='utf-8') as f:
-                                userData = json.load(f)
-                            
-                            #установить статус офлайн
-                            userData['status'] = 'offline'
-                            
-                            with open(userPath, 'w', encoding='utf-8') as f:
-                                json.dump(userData, f, ensure_ascii=False, indent=2)
+                        #после теплого старта идет параллельно с входами и createChat -
+                        #проверка и запись под той же блокировкой, что у них
+                        with self.userLock(username):
+                            if username in self.onlineUsers:
+                                #уже успел войти после старта
+                                continue
+                            if self.clusterNode and self.clusterNode.locateUser(username):
+                                #онлайн на другом узле кластера
+                                continue
+                            try:
+                                with open(userPath, 'r', encoding='utf-8') as f:
+                                    userData = json.load(f)
+                                
+                                #установить статус офлайн
+                                userData['status'] = 'offline'
+                                self.saveUser(username, userData, updateStatus=False)
                                 
-                            print(f"  {username} -> offline")
-                        except Exception as e:
-                            print(f"ошибка обновления {username}: {e}")
+                                print(f"  {username} -> offline")
+                            except Exception as e:
+                                print(f"ошибка обновления {username}: {e}")
         except Exception as e:
             print(f"ошибка установки офлайн статуса: {e}")
     
+    #доделать старт из снимка в фоне
+    def finishRestore(self, stale: List[str]):
+        self.checkpointer.warmUp(self, stale)
+        self.setAllUsersOffline()
+    
+    #запустить компоненты сервера до приема подключений
+    def startComponents(self):
+        self.sessionSecret = auth.loadSecret(self.secretPath)
+        if self.certFile:
+            self.sslContext = self.createSslContext()
+        self.migrateClients()
+        stale = self.checkpointer.restore(self) if self.checkpointer else None
+        if stale is None:
+            self.loadChats()
+        self.chatsLoaded = True
+        if self.clusterNode:
+            self.clusterNode.start(self.handleClusterFrame)
+        if self.replicationLog:
+            self.replicationLog.start(self.sessionSecret)
+            if self.replicationLog.lastSeq == 0:
+                self.replicateBaseline()
+        if self.attachmentPort:
+            self.attachmentServer = attachments.AttachmentServer(
+                store=attachments.BlobStore(self.blobDir),
+                host=self.host,
+                port=self.attachmentPort,
+                authenticate=self.authenticateToken,
+                onUploaded=self.postAttachment,
+                canAccess=self.canPostTo,
+                sslContext=self.sslContext
+            )
+            self.attachmentServer.start()
+        if stale is None:
+            self.setAllUsersOffline()
+        else:
+            #теплый старт: догрузка и проверка статусов идут уже во время работы
+            threading.Thread(target=self.finishRestore, args=(stale,), daemon=True).start()
+        if self.checkpointer:
+            self.checkpointer.start(self)
+    
     #запустить сервер
     def start(self):
-        self.loadChats()
-        self.setAllUsersOffline()
-        
         try:
+            #внутри try: при ошибке (например, занятый порт) stop уберет уже запущенное
+            self.startComponents()
             self.serverSocket = locsoc.socket(locsoc.AF_INET, locsoc.SOCK_STREAM)
+            #перезапуск не должен ждать TIME_WAIT старых соединений
+            self.serverSocket.setsockopt(locsoc.SOL_SOCKET, locsoc.SO_REUSEADDR, 1)
             self.serverSocket.bind((self.host, self.port))
             self.serverSocket.listen(5)
             self.running = True
             
-            print(f"сервер запущен на {self.host}:{self.port}")
+            print(f"сервер запущен на {self.host}:{self.port}{' (TLS)' if self.sslContext else ''}")
             print(f"загружено чатов: {len(self.chats)}")
             
+            reaper = threading.Thread(target=self.reapSessions, daemon=True)
+            reaper.start()
+            
             while self.running:
                 try:
                     clientSocket, address = self.serverSocket.accept()
@@ -391,16 +856,97 @@ class Server:
             self.handleLogout(username)
         
         self.running = False
+        if self.checkpointer:
+            self.checkpointer.stop()
+        if self.checkpointer and self.chatsLoaded:
+            try:
+                self.checkpointer.write(self)
+            except Exception as e:
+                print(f"ошибка записи снимка: {e}")
+        if self.clusterNode:
+            self.clusterNode.stop()
+        if self.replicationLog:
+            self.replicationLog.stop()
+        if self.attachmentServer:
+            self.attachmentServer.stop()
+        self.kdfPool.shutdown(wait=False)
         if self.serverSocket:
             self.serverSocket.close()
         print("сервер остановлен, все пользователи offline")
 
 def main():
-    server = Server()
+    parser = argparse.ArgumentParser(description="сервер чата")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('--attachment-port', type=int, default=0,
+                        help="включить канал вложений на этом порту (каждому узлу кластера свой, клиент по умолчанию ждет 8889)")
+    parser.add_argument('--cert', help="сертификат PEM для TLS")
+    parser.add_argument('--key', help="закрытый ключ PEM (если не в файле сертификата)")
+    parser.add_argument('--data-dir', default='.', help="директория с clients.json, chats.json и историями")
+    parser.add_argument('--secret', help="файл секрета сессий (по умолчанию <data-dir>/server_secret.key)")
+    parser.add_argument('--node-id', help="включить режим кластера с этим id узла")
+    parser.add_argument('--cluster-host', default='localhost')
+    parser.add_argument('--cluster-port', type=int, default=9888)
+    parser.add_argument('--presence-dir', default='cluster')
+    parser.add_argument('--replication-port', type=int, help="вести журнал изменений и отдавать его резерву")
+    parser.add_argument('--standby-of', metavar='HOST:PORT', help="работать теплым резервом этого основного (нужен --secret основного)")
+    parser.add_argument('--promote-after', type=float, default=0, help="стать основным после стольких секунд без связи")
+    args = parser.parse_args()
+    if args.standby_of and not (args.secret and os.path.exists(args.secret)):
+        #новый случайный секрет основной все равно отвергнет
+        parser.error("для --standby-of нужен --secret: файл секрета основного сервера")
+    
+    clusterNode = None
+    if args.node_id:
+        clusterNode = cluster.ClusterNode(
+            nodeId=args.node_id,
+            host=args.cluster_host,
+            port=args.cluster_port,
+            presenceDir=args.presence_dir
+        )
+    
+    replicationLog = None
+    if args.replication_port:
+        replicationLog = replication.ReplicationLog(
+            logPath=os.path.join(args.data_dir, "replication.log"),
+            host=args.host,
+            port=args.replication_port
+        )
+    
+    server = Server(
+        host=args.host,
+        port=args.port,
+        clientsPath=os.path.join(args.data_dir, "clients.json"),
+        usersDir=os.path.join(args.data_dir, "clients_story"),
+        chatsPath=os.path.join(args.data_dir, "chats.json"),
+        historyDir=os.path.join(args.data_dir, "chats_story"),
+        secretPath=args.secret or os.path.join(args.data_dir, "server_secret.key"),
+        attachmentPort=args.attachment_port or None,
+        blobDir=os.path.join(args.data_dir, "attachments"),
+        #узлы кластера делят data-dir, поэтому снимок у каждого свой
+        checkpointer=checkpoint.Checkpointer(path=os.path.join(
+            args.data_dir, f"checkpoint-{args.node_id}.bin" if args.node_id else "checkpoint.bin")),
+        certFile=args.cert,
+        keyFile=args.key,
+        clusterNode=clusterNode,
+        replicationLog=replicationLog
+    )
     try:
+        if args.standby_of:
+            primaryHost, primaryPort = args.standby_of.rsplit(':', 1)
+            standby = replication.Standby(
+                server=server,
+                primaryHost=primaryHost,
+                primaryPort=int(primaryPort),
+                positionPath=os.path.join(args.data_dir, "replica.pos")
+            )
+            #резерв подписывается тем же секретом, что и основной
+            standby.run(auth.loadSecret(server.secretPath), args.promote_after)
         server.start()
     except KeyboardInterrupt:
         print("\nостановка сервера...")
+    except PermissionError as e:
+        print(f"резерв: {e}")
     except Exception as e:
         print(f"ошибка: {e}")
 